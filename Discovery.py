@@ -1,7 +1,12 @@
+import datetime
 import pandas as pd
 import streamlit as st
 import altair as alt
-from data_processing import finalize_data
+from data_processing import HEADLINE_START, get_dataset, kpi_summary, refresh_data
+from filter_index import get_filter_index
+from distinct_cube import get_distinct_cube
+from time_rollups import AXIS_FORMATS, get_time_rollups, pick_granularity
+from chart_cache import altair_chart
 
 def run(navigate_to):
     # Menambahkan logo di atas sidebar
@@ -24,13 +29,16 @@ def run(navigate_to):
             navigate_to("results")
 
     # Mengambil data dari data_processing
-    df_discovery, df_sap, merged_df = finalize_data()
-
-    # Membersihkan dan mengonversi kolom
-    merged_df['nik'] = merged_df['nik'].astype(str).str.replace(',', '')
-    merged_df['Customer ID'] = merged_df['Customer ID'].astype(str).str.replace(',', '')
-    merged_df["Test Date"] = pd.to_datetime(merged_df["Test Date"])
-    merged_df["Register Date"] = pd.to_datetime(merged_df["Register Date"])
+    # Kolom sudah dibersihkan dan bertipe di data_processing
+    # Selama data mentah belum dimuat, angka utama diambil dari agregat MySQL
+    dataset = get_dataset(wait=False)
+    if dataset is None:
+        if not st.session_state.get('load_rows'):
+            show_headline()
+            return
+        with st.spinner("Memuat data lengkap..."):
+            dataset = get_dataset()
+    merged_df = dataset.merged
 
     # Menyiapkan filter tanggal
     startDate_test, endDate_test = merged_df["Test Date"].min(), merged_df["Test Date"].max()
@@ -49,10 +57,9 @@ def run(navigate_to):
     with col4:
         date4 = st.date_input("End Date (Register Date)", endDate_register)
 
-    # Memfilter data berdasarkan tanggal
-    df_test_filtered = merged_df[(merged_df["Test Date"] >= pd.to_datetime(date1)) & (merged_df["Test Date"] <= pd.to_datetime(date2))]
-    df_register_filtered = merged_df[(merged_df["Register Date"] >= pd.to_datetime(date3)) & (merged_df["Register Date"] <= pd.to_datetime(date4))]
-    df_filtered = df_test_filtered[(df_test_filtered["Register Date"] >= pd.to_datetime(date3)) & (df_test_filtered["Register Date"] <= pd.to_datetime(date4))]
+    # Memfilter data berdasarkan tanggal, rentang dicari pada indeks tanggal yang terurut
+    index = get_filter_index(dataset)
+    date_ranges = {"Test Date": (date1, date2), "Register Date": (date3, date4)}
 
     # Menambahkan catatan
     st.markdown("""
@@ -61,45 +68,38 @@ def run(navigate_to):
     - **Register Date** mempengaruhi semua chart.
     """)
 
+    # Memuat ulang data dari sumber di latar belakang, data saat ini tetap ditampilkan
+    if st.sidebar.button("Refresh Data"):
+        refresh_data()
+        st.sidebar.info("Data sedang diperbarui di latar belakang.")
+
     # Sidebar filters
     st.sidebar.header("Filter Options")
     name_input = st.sidebar.text_input("Filter by Name", "")
 
     filters = {
-        'nik': st.sidebar.multiselect("Filter NIK", list(merged_df['nik'].dropna().unique()), default=[]),
-        'gender': st.sidebar.multiselect("Filter Gender", list(merged_df['gender'].dropna().unique()), default=[]),
-        'unit': st.sidebar.multiselect("Filter Unit", list(merged_df['unit'].dropna().unique()), default=[]),
-        'Last Education': st.sidebar.multiselect("Filter Last Education", list(merged_df['Last Education'].dropna().unique()), default=[]),
-        'Company': st.sidebar.multiselect("Filter Company", list(merged_df['Company'].dropna().unique()), default=[]),
-        'Province': st.sidebar.multiselect("Filter Province", list(merged_df['Province'].dropna().unique()), default=[]),
-        'generation': st.sidebar.multiselect("Filter Generation", list(merged_df['generation'].dropna().unique()), default=[]),
-        'layer': st.sidebar.multiselect("Filter Layer", list(merged_df['layer'].dropna().unique()), default=[]),
+        'nik': st.sidebar.multiselect("Filter NIK", index.options('nik'), default=[]),
+        'gender': st.sidebar.multiselect("Filter Gender", index.options('gender'), default=[]),
+        'unit': st.sidebar.multiselect("Filter Unit", index.options('unit'), default=[]),
+        'Last Education': st.sidebar.multiselect("Filter Last Education", index.options('Last Education'), default=[]),
+        'Company': st.sidebar.multiselect("Filter Company", index.options('Company'), default=[]),
+        'Province': st.sidebar.multiselect("Filter Province", index.options('Province'), default=[]),
+        'generation': st.sidebar.multiselect("Filter Generation", index.options('generation'), default=[]),
+        'layer': st.sidebar.multiselect("Filter Layer", index.options('layer'), default=[]),
         'status': st.sidebar.multiselect("Filter Status", ["Internal", "External"], default=[])
     }
     
-    # Apply filters based on sidebar input
-    if name_input:
-        df_filtered = df_filtered[df_filtered["name"].str.contains(name_input, case=False, na=False)]
+    # Menghitung jumlah pengguna, filter sidebar dan tanggal diterapkan pada distinct-count cube
+    cube = get_distinct_cube(dataset)
+    total_registered_users = cube.count(dates={"Register Date": (date3, date4)})
 
-    for key, value in filters.items():
-        if value:  # If the filter has selections, apply it
-            df_filtered = df_filtered[df_filtered[key].isin(value)]
-
-    # Menghitung jumlah pengguna
-    total_registered_users = df_register_filtered['Customer ID'].nunique()
-    total_active_users = df_filtered['Customer ID'].nunique()
-    total_internal_users = df_filtered[df_filtered['status'] == 'Internal']['Customer ID'].nunique()
-    total_external_users = df_filtered[df_filtered['status'] == 'External']['Customer ID'].nunique()
+    total_active_users = cube.count(filters, date_ranges, name_input)
+    status_counts = cube.count(filters, date_ranges, name_input, by=['status']).set_index('status')['Customer ID']
+    total_internal_users = int(status_counts.get('Internal', 0))
+    total_external_users = int(status_counts.get('External', 0))
 
     # Menampilkan informasi "DISCOVERY USER"
-    st.markdown("<h3>DISCOVERY USER</h3>", unsafe_allow_html=True)
-    col1, col2, col3 = st.columns(3)
-    with col1:
-        st.markdown(f"<p style='font-size: 20px; text-align: center;'><strong>Overall: <span style='color: red;'>{total_active_users:,}</span></strong></p>", unsafe_allow_html=True)
-    with col2:
-        st.markdown(f"<p style='font-size: 20px; text-align: center;'><strong>Internal User: <span style='color: red;'>{total_internal_users:,}</span></strong></p>", unsafe_allow_html=True)
-    with col3:
-        st.markdown(f"<p style='font-size: 20px; text-align: center;'><strong>External User: <span style='color: red;'>{total_external_users:,}</span></strong></p>", unsafe_allow_html=True)
+    show_user_tiles(total_active_users, total_internal_users, total_external_users)
 
     # Menampilkan tabel berdasarkan dropdown
     st.subheader("Select Table to Display")
@@ -116,83 +116,87 @@ def run(navigate_to):
 
     # Menyiapkan tabel breakdown
     breakdown_column = table_dict[table_option]
-    internal_breakdown = df_filtered[df_filtered['status'] == 'Internal'].groupby(breakdown_column)['Customer ID'].nunique().reset_index()
+    status_breakdown = cube.count(filters, date_ranges, name_input, by=[breakdown_column, 'status'])
+    internal_breakdown = status_breakdown[status_breakdown['status'] == 'Internal'].drop(columns=['status'])
     internal_breakdown.columns = [breakdown_column, 'Internal Count']
-    external_breakdown = df_filtered[df_filtered['status'] == 'External'].groupby(breakdown_column)['Customer ID'].nunique().reset_index()
+    external_breakdown = status_breakdown[status_breakdown['status'] == 'External'].drop(columns=['status'])
     external_breakdown.columns = [breakdown_column, 'External Count']
-    breakdown_table = pd.merge(internal_breakdown, external_breakdown, on=breakdown_column, how='outer').fillna(0)
+    breakdown_table = pd.merge(internal_breakdown, external_breakdown, on=breakdown_column, how='outer').fillna({'Internal Count': 0, 'External Count': 0})
     st.write(f"### Breakdown by {table_option}")
     st.dataframe(breakdown_table)
 
     # Pie chart untuk distribusi gender
-    gender_breakdown = df_filtered.groupby(['gender', 'status'])['Customer ID'].nunique().reset_index()
-    gender_summary = gender_breakdown.groupby('gender')['Customer ID'].sum().reset_index()
+    gender_breakdown = cube.count(filters, date_ranges, name_input, by=['gender', 'status'])
+    gender_summary = gender_breakdown.groupby('gender', observed=True)['Customer ID'].sum().reset_index()
     gender_summary.columns = ['Gender', 'Count']
-    pie_chart = alt.Chart(gender_summary).mark_arc().encode(
-        theta=alt.Theta(field="Count", type="quantitative"),
-        color=alt.Color(field="Gender", type="nominal"),
-        tooltip=[alt.Tooltip('Gender', title='Gender'), alt.Tooltip('Count', title='Count')]
-    ).properties(title='Gender Distribution')
-    st.altair_chart(pie_chart, use_container_width=True)
+    def pie_chart(data):
+        return alt.Chart(data).mark_arc().encode(
+            theta=alt.Theta(field="Count", type="quantitative"),
+            color=alt.Color(field="Gender", type="nominal"),
+            tooltip=[alt.Tooltip('Gender', title='Gender'), alt.Tooltip('Count', title='Count')]
+        ).properties(title='Gender Distribution')
+    # Chart disimpan per data agregat, tidak dibangun ulang selama datanya sama
+    altair_chart('discovery_gender', gender_summary, pie_chart, use_container_width=True)
     
-    # Count unique active learners by test date
-    active_learners_counts = (df_filtered
-                              .groupby('Register Date')
-                              .agg(active_learners=('Customer ID', 'nunique'))
-                              .reset_index())
+    # Count unique active learners by register date, per day, week or month depending on the selected range
+    rollups = get_time_rollups(dataset)
+    register_granularity = pick_granularity(date3, date4)
+    register_format = AXIS_FORMATS[register_granularity]
+    active_learners_counts = rollups.series('Register Date', register_granularity, filters, date_ranges, name_input, count_name='active_learners')
 
     # Create a line chart for active learners
     st.subheader("Registered Users Over Time")
-    line_chart = alt.Chart(active_learners_counts).mark_line(
-        stroke='steelblue',  # Change the line color
-        strokeWidth=2  # Increase line width for better visibility
-    ).encode(
-        x=alt.X('Register Date:T', title='Register Date', 
-                axis=alt.Axis(format='%Y-%m-%d', labelAngle=-45)),  # Tilt x-axis labels
-        y=alt.Y('active_learners:Q', axis=alt.Axis(titleColor='black')),
-        tooltip=[
-            alt.Tooltip('Register Date:T', title='Register Date', format='%Y-%m-%d'), 
-            alt.Tooltip('active_learners:Q', title='Active Learners')
-        ]
-    ).properties(
-        width=600,
-        height=400
-    )
+    def line_chart(data):
+        return alt.Chart(data).mark_line(
+            stroke='steelblue',  # Change the line color
+            strokeWidth=2  # Increase line width for better visibility
+        ).encode(
+            x=alt.X('Register Date:T', title=f'Register Date (per {register_granularity})', 
+                    axis=alt.Axis(format=register_format, labelAngle=-45)),  # Tilt x-axis labels
+            y=alt.Y('active_learners:Q', axis=alt.Axis(titleColor='black')),
+            tooltip=[
+                alt.Tooltip('Register Date:T', title='Register Date', format=register_format), 
+                alt.Tooltip('active_learners:Q', title='Active Learners')
+            ]
+        ).properties(
+            width=600,
+            height=400
+        )
 
     # Display the chart
-    st.altair_chart(line_chart, use_container_width=True)
+    altair_chart('discovery_registered', active_learners_counts, line_chart, params=register_granularity, use_container_width=True)
 
     # Tombol untuk menampilkan data tabel Registered Users
     if st.button("Show Data Table for Registered Users"):
         st.write(active_learners_counts)
 
     # Grafik garis untuk Active Users
-    # Count unique active learners by test date
-    active_learner_counts = (df_filtered
-                              .groupby('Test Date')
-                              .agg(active_learner=('Customer ID', 'nunique'))
-                              .reset_index())
+    # Count unique active learners by test date, per day, week or month depending on the selected range
+    test_granularity = pick_granularity(date1, date2)
+    test_format = AXIS_FORMATS[test_granularity]
+    active_learner_counts = rollups.series('Test Date', test_granularity, filters, date_ranges, name_input, count_name='active_learner')
     
     # Create a line chart for active learners
     st.subheader("Active User Over Time")
-    chart_line = alt.Chart(active_learner_counts).mark_line(
-        stroke='steelblue',  # Change the line color
-        strokeWidth=2  # Increase line width for better visibility
-    ).encode(
-        x=alt.X('Test Date:T', title='Test Date', 
-                axis=alt.Axis(format='%Y-%m-%d', labelAngle=-45)),  # Tilt x-axis labels
-        y=alt.Y('active_learner:Q', axis=alt.Axis(titleColor='black')),
-        tooltip=[
-            alt.Tooltip('Test Date:T', title='Test Date', format='%Y-%m-%d'), 
-            alt.Tooltip('active_learner:Q', title='Active Learner')
-        ]
-    ).properties(
-        width=600,
-        height=400
-    )
+    def chart_line(data):
+        return alt.Chart(data).mark_line(
+            stroke='steelblue',  # Change the line color
+            strokeWidth=2  # Increase line width for better visibility
+        ).encode(
+            x=alt.X('Test Date:T', title=f'Test Date (per {test_granularity})', 
+                    axis=alt.Axis(format=test_format, labelAngle=-45)),  # Tilt x-axis labels
+            y=alt.Y('active_learner:Q', axis=alt.Axis(titleColor='black')),
+            tooltip=[
+                alt.Tooltip('Test Date:T', title='Test Date', format=test_format), 
+                alt.Tooltip('active_learner:Q', title='Active Learner')
+            ]
+        ).properties(
+            width=600,
+            height=400
+        )
 
     # Display the chart
-    st.altair_chart(chart_line, use_container_width=True)
+    altair_chart('discovery_active', active_learner_counts, chart_line, params=test_granularity, use_container_width=True)
     
     # Tombol untuk menampilkan data tabel Active Users
     if st.button("Show Data Table for Active Users"):
@@ -200,12 +204,76 @@ def run(navigate_to):
 
    # Grafik bar charts untuk generation
     st.subheader("Generation Distribution")
-    generation_distribution = df_filtered.groupby('generation')['Customer ID'].nunique().reset_index(name='Generation User')
+    generation_distribution = cube.count(filters, date_ranges, name_input, by=['generation'])
     generation_distribution.columns = ['Generation', 'Count']
-    generation_bar_chart = alt.Chart(generation_distribution).mark_bar().encode(
-        x=alt.X('Generation:O', title='Generation'),
-        y=alt.Y('Count:Q', title='Users'),
-        color=alt.Color('Generation:O', title='Generation'),
-        tooltip=['Generation', 'Count']
-    ).properties(width=800, height=300)
-    st.altair_chart(generation_bar_chart, use_container_width=True)
+    def generation_bar_chart(data):
+        return alt.Chart(data).mark_bar().encode(
+            x=alt.X('Generation:O', title='Generation'),
+            y=alt.Y('Count:Q', title='Users'),
+            color=alt.Color('Generation:O', title='Generation'),
+            tooltip=['Generation', 'Count']
+        ).properties(width=800, height=300)
+    altair_chart('discovery_generation', generation_distribution, generation_bar_chart, use_container_width=True)
+
+def show_user_tiles(total_active_users, total_internal_users, total_external_users):
+    st.markdown("<h3>DISCOVERY USER</h3>", unsafe_allow_html=True)
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.markdown(f"<p style='font-size: 20px; text-align: center;'><strong>Overall: <span style='color: red;'>{total_active_users:,}</span></strong></p>", unsafe_allow_html=True)
+    with col2:
+        st.markdown(f"<p style='font-size: 20px; text-align: center;'><strong>Internal User: <span style='color: red;'>{total_internal_users:,}</span></strong></p>", unsafe_allow_html=True)
+    with col3:
+        st.markdown(f"<p style='font-size: 20px; text-align: center;'><strong>External User: <span style='color: red;'>{total_external_users:,}</span></strong></p>", unsafe_allow_html=True)
+
+def show_headline():
+    # Angka utama dari agregat MySQL per rentang tanggal, tanpa memuat data mentah
+    today = datetime.date.today()
+    col1, col2 = st.columns(2)
+    with col1:
+        date1 = st.date_input("Start Date (Test Date)", HEADLINE_START)
+    with col2:
+        date2 = st.date_input("End Date (Test Date)", today)
+
+    col3, col4 = st.columns(2)
+    with col3:
+        date3 = st.date_input("Start Date (Register Date)", HEADLINE_START)
+    with col4:
+        date4 = st.date_input("End Date (Register Date)", today)
+
+    status_summary = kpi_summary('status', (date1, date2), (date3, date4))
+    daily_summary = kpi_summary('day', (date1, date2), (date3, date4))
+    if status_summary is None or daily_summary is None:
+        st.error("Angka utama tidak dapat diambil, muat data lengkap untuk melihat dashboard.")
+    else:
+        # Pengguna dihitung unik per status, jadi Overall adalah jumlah kedua status
+        status_counts = status_summary.set_index('status')['users']
+        total_internal_users = int(status_counts.get('Internal', 0))
+        total_external_users = int(status_counts.get('External', 0))
+        show_user_tiles(total_internal_users + total_external_users, total_internal_users, total_external_users)
+
+        # Active user per hari, dijumlahkan atas status
+        active_learner_counts = daily_summary.groupby('Test Date', as_index=False)['users'].sum()
+        active_learner_counts['Test Date'] = pd.to_datetime(active_learner_counts['Test Date'])
+        active_learner_counts.columns = ['Test Date', 'active_learner']
+
+        st.subheader("Active User Over Time")
+        def chart_line(data):
+            return alt.Chart(data).mark_line(
+                stroke='steelblue',
+                strokeWidth=2
+            ).encode(
+                x=alt.X('Test Date:T', title='Test Date (per day)', axis=alt.Axis(format=AXIS_FORMATS['day'], labelAngle=-45)),
+                y=alt.Y('active_learner:Q', axis=alt.Axis(titleColor='black')),
+                tooltip=[
+                    alt.Tooltip('Test Date:T', title='Test Date', format=AXIS_FORMATS['day']),
+                    alt.Tooltip('active_learner:Q', title='Active Learner')
+                ]
+            ).properties(
+                width=600,
+                height=400
+            )
+        altair_chart('discovery_headline_active', active_learner_counts, chart_line, use_container_width=True)
+
+    # Filter, breakdown dan grafik lainnya membutuhkan data mentah
+    st.info("Filter, tabel breakdown dan grafik lainnya tersedia setelah data lengkap dimuat.")
+    st.button("Muat Data Lengkap", on_click=lambda: st.session_state.update(load_rows=True))
@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+
+# One attempt is one user taking one test on one day, only its highest score counts
+BEST_ATTEMPT_KEYS = ['bundle_name', 'email', 'Test Date', 'Test Name']
+
+# The latest attempt of every user and test
+LATEST_ATTEMPT_KEYS = ['email', 'Test Name']
+
+
+def _sort_codes(column):
+    # Integer codes ordered like groupby orders the values, -1 for missing values
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column.cat.codes.to_numpy()
+    return pd.factorize(column, sort=True)[0]
+
+def _descending_key(column):
+    if pd.api.types.is_datetime64_any_dtype(column):
+        return -column.to_numpy(dtype='datetime64[ns]').view(np.int64)
+    return -column.to_numpy(dtype=np.float64, na_value=np.nan)
+
+# "First row per group by some order" selection, like df.loc[df.groupby(keys)[order_by].idxmax()],
+# materialised once per data version. Rows are sorted by the group keys and then by order_by
+# descending, ties keeping row order, with one sort instead of a groupby per rerun. Rows with
+# a missing key or order_by value never take part, as in the groupby.
+class AttemptSelection:
+    def __init__(self, df, keys, order_by):
+        codes = [_sort_codes(df[key]) for key in keys]
+        valid = df[order_by].notna().to_numpy()
+        for key_codes in codes:
+            valid &= key_codes >= 0
+        positions = np.flatnonzero(valid)
+        columns = [key_codes[positions] for key_codes in codes]
+        # lexsort sorts by its last key first and is stable
+        order = np.lexsort([_descending_key(df[order_by])[positions]] + columns[::-1])
+        self.size = len(df)
+        self.rows = positions[order]
+        starts = np.zeros(len(order), dtype=bool)
+        starts[:1] = True
+        for key_codes in columns:
+            sorted_codes = key_codes[order]
+            starts[1:] |= sorted_codes[1:] != sorted_codes[:-1]
+        self.groups = np.cumsum(starts) - 1
+
+    def select(self, labels=None):
+        # The selected row of every group among labels (row positions of the dataset, which is
+        # what the index of a filtered merged_df holds), in group order like the groupby
+        rows, groups = self.rows, self.groups
+        if labels is not None:
+            mask = np.zeros(self.size, dtype=bool)
+            mask[np.asarray(labels)] = True
+            kept = mask[rows]
+            rows, groups = rows[kept], groups[kept]
+        first = np.ones(len(rows), dtype=bool)
+        first[1:] = groups[1:] != groups[:-1]
+        return rows[first]
+
+def get_best_attempts(dataset):
+    return dataset.derived('best_attempts', lambda dataset: AttemptSelection(dataset.merged, BEST_ATTEMPT_KEYS, 'total_score'))
+
+def get_latest_attempts(dataset, keys=LATEST_ATTEMPT_KEYS):
+    # Latest attempt per keys, of every user and test by default
+    return dataset.derived(('latest_attempts', tuple(keys)), lambda dataset: AttemptSelection(dataset.merged, list(keys), 'Test Date'))
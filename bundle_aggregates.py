@@ -0,0 +1,137 @@
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from attempts import get_best_attempts
+
+# What Test Result shows for every bundle, in page order:
+# 'typology' is the distribution of typologies per test, 'final_result' the distribution of final
+# results over the best attempts and 'rank' the users per test at each rank (1..top) of their
+# best scores on a test day.
+BUNDLE_SPECS = {
+    'GI': {'title': 'Growth Inventory', 'outputs': ['typology']},
+    'LEAN': {'title': 'LEAN', 'outputs': ['typology', 'final_result']},
+    'ELITE': {'title': 'ELITE', 'outputs': ['typology', 'final_result']},
+    'Genuine': {'title': 'Genuine', 'outputs': ['rank'], 'top': 9},
+    'Astaka': {'title': 'Astaka', 'outputs': ['rank'], 'top': 6},
+}
+
+# Filtered rankings kept per bundle and filter state, the least recently used ones are dropped first
+RANK_CACHE_SIZE = 32
+
+
+def _bundles_with(specs, output):
+    return [bundle for bundle, spec in specs.items() if output in spec['outputs']]
+
+def typology_distribution(df):
+    distribution = df.groupby(['bundle_name', 'Test Name', 'typology'], observed=True)['Customer ID'].nunique().reset_index(name='Active Users')
+    return _with_percentage(distribution)
+
+def _with_percentage(distribution):
+    total_per_test = distribution.groupby(['bundle_name', 'Test Name'], observed=True)['Active Users'].transform('sum')
+    distribution['Percentage'] = (distribution['Active Users'] / total_per_test * 100).round(2)
+    return distribution
+
+def final_result_distribution(best):
+    # Each user counts once per test day and final result
+    results = best[['Customer ID', 'Test Date', 'final_result']].drop_duplicates()
+    counts = results['final_result'].value_counts().loc[lambda counts: counts > 0].reset_index()
+    counts.columns = ['Final Result', 'Count']
+    counts['Percentage'] = (counts['Count'] / counts['Count'].sum()) * 100
+    return counts
+
+def rank_counts(ranked):
+    return ranked.groupby(['rank', 'Test Name'], observed=True)['Customer ID'].nunique().reset_index(name='Total Active Users')
+
+# Rank of every best attempt within its session (one user on one test day, 1 is the highest
+# score) for the bundles with a 'rank' output, down to each bundle's top, built once per data
+# version. The users per test at every rank are precomputed for the unfiltered data, so picking
+# another rank is a lookup. Filtered views rank the best attempts among the filtered rows, as
+# one best attempt of a user may be filtered out while another (e.g. a duplicate SAP row) is not;
+# they are kept per filtered row set, so reruns on an unchanged filter are lookups as well.
+class RankTable:
+    def __init__(self, dataset, tops):
+        self._merged = dataset.merged
+        self._best = get_best_attempts(dataset)
+        self._tops = tops
+        self._ranked = self._rank(list(tops), self._best.select())
+        self._counts = {bundle: rank_counts(ranked) for bundle, ranked in self._ranked.items()}
+        self._filtered = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _rank(self, bundles, rows):
+        best = self._merged.take(rows)
+        best = best.loc[best['bundle_name'].isin(bundles), ['bundle_name', 'Customer ID', 'Test Date', 'Test Name', 'total_score']]
+        best['rank'] = best.groupby(['bundle_name', 'Customer ID', 'Test Date'], observed=True, dropna=False)['total_score'].rank(ascending=False, method='first').astype(int)
+        return {bundle: best[(best['bundle_name'] == bundle) & (best['rank'] <= self._tops[bundle])].drop(columns=['bundle_name'])
+                for bundle in bundles}
+
+    def _filtered_ranking(self, bundle, labels):
+        # Ranked best attempts and their counts among labels, keyed by a digest of the labels
+        digest = hashlib.blake2b(np.asarray(labels, dtype=np.int64).tobytes(), digest_size=16).digest()
+        key = (bundle, digest)
+        with self._lock:
+            if key in self._filtered:
+                self._filtered.move_to_end(key)
+                return self._filtered[key]
+        ranked = self._rank([bundle], self._best.select(labels))[bundle]
+        ranking = (ranked, rank_counts(ranked))
+        with self._lock:
+            self._filtered[key] = ranking
+            while len(self._filtered) > RANK_CACHE_SIZE:
+                self._filtered.popitem(last=False)
+        return ranking
+
+    def ranked(self, bundle, labels=None):
+        # Ranked best attempts of bundle among labels (row positions of the dataset).
+        # The frame is shared and must not be modified
+        if labels is None:
+            return self._ranked[bundle]
+        return self._filtered_ranking(bundle, labels)[0]
+
+    def counts(self, bundle, labels=None):
+        # Users per rank and test, among labels
+        if labels is None:
+            return self._counts[bundle]
+        return self._filtered_ranking(bundle, labels)[1]
+
+def get_rank_table(dataset, specs=BUNDLE_SPECS):
+    tops = {bundle: spec['top'] for bundle, spec in specs.items() if 'rank' in spec['outputs']}
+    return dataset.derived('rank_table', lambda dataset: RankTable(dataset, tops))
+
+def _split(df, bundle):
+    return df[df['bundle_name'] == bundle].drop(columns=['bundle_name']).reset_index(drop=True)
+
+# Every output of every bundle in specs, computed with one grouped pass per kind of output
+# over the rows of df (merged_df of dataset, filtered) instead of re-filtering them per bundle.
+# Returns, per bundle, a frame for each of its outputs.
+def aggregate_bundles(dataset, df, specs=BUNDLE_SPECS):
+    results = {bundle: {} for bundle in specs}
+
+    typology_bundles = _bundles_with(specs, 'typology')
+    if typology_bundles:
+        distribution = typology_distribution(df)
+        for bundle in typology_bundles:
+            results[bundle]['typology'] = _split(distribution, bundle)
+
+    final_result_bundles = _bundles_with(specs, 'final_result')
+    if final_result_bundles:
+        # Highest-scoring row of every attempt, from the selection materialised per data version
+        best = df.loc[get_best_attempts(dataset).select(df.index)]
+        groups = dict(list(best.groupby('bundle_name', observed=True)))
+        for bundle in final_result_bundles:
+            results[bundle]['final_result'] = final_result_distribution(groups.get(bundle, best.iloc[:0]))
+
+    # Ranks come from the rank table, without filters the counts are precomputed as well
+    labels = None if len(df) == len(dataset.merged) else df.index
+    for bundle in _bundles_with(specs, 'rank'):
+        results[bundle]['rank'] = get_rank_table(dataset, specs).counts(bundle, labels)
+    return results
+
+# Typology distributions of the bundles in specs from the 'test' KPI aggregate (distinct users
+# per bundle, test, typology and status). A user has one status, so the statuses add up.
+def aggregate_typologies(summary, specs=BUNDLE_SPECS):
+    summary = summary.dropna(subset=['bundle_name', 'Test Name', 'typology'])
+    distribution = _with_percentage(summary.groupby(['bundle_name', 'Test Name', 'typology'])['users'].sum().reset_index(name='Active Users'))
+    return {bundle: _split(distribution, bundle) for bundle in _bundles_with(specs, 'typology')}
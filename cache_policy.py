@@ -0,0 +1,86 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# Stale-while-revalidate cache around a loader function.
+# The first get() blocks until the loader returns. Afterwards get() always answers with the
+# current value at once and starts a background refresh once that value is older than ttl.
+# A refresh swaps the new value in as a whole; when it fails the last good value is kept.
+# A refresh that returns the current value, or one same(current, new) considers equal, only
+# renews loaded_at: version and on_update are kept for changed data.
+class CachedLoader:
+    def __init__(self, name, load, ttl, on_update=None, same=None):
+        self.name = name
+        self.ttl = ttl
+        self._load = load
+        self._on_update = on_update
+        self._same = same
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._refresh_thread = None
+        self.loading = False
+        self.value = None
+        self.version = 0
+        self.loaded_at = None
+        self.last_error = None
+
+    @property
+    def loaded(self):
+        return self.loaded_at is not None
+
+    @property
+    def refreshing(self):
+        return self._refresh_thread is not None and self._refresh_thread.is_alive()
+
+    def is_stale(self):
+        return self.loaded and time.monotonic() - self.loaded_at > self.ttl
+
+    def get(self):
+        if not self.loaded:
+            self._run_load(raise_errors=True)
+        elif self.is_stale():
+            self.refresh()
+        return self.value
+
+    def refresh(self):
+        # Start a background refresh unless one is already running
+        with self._lock:
+            if self.refreshing:
+                return
+            self._refresh_thread = threading.Thread(target=self._run_load, name=f'{self.name}-refresh', daemon=True)
+            self._refresh_thread.start()
+
+    def _run_load(self, raise_errors=False):
+        with self._load_lock:
+            # Another caller finished a load while this one was waiting
+            if raise_errors and self.loaded:
+                return
+            # Set while the loader runs, so callers can tell a load is already in flight
+            self.loading = True
+            try:
+                value = self._load()
+            except Exception as e:
+                self.last_error = e
+                if raise_errors:
+                    raise
+                logger.error("Refreshing %s failed, keeping the last good data: %s", self.name, e)
+                return
+            finally:
+                self.loading = False
+            changed = not self._unchanged(value)
+            with self._lock:
+                if changed:
+                    self.value = value
+                    self.version += 1
+                self.loaded_at = time.monotonic()
+                self.last_error = None
+        if changed and self._on_update is not None:
+            self._on_update()
+
+    def _unchanged(self, value):
+        if not self.loaded:
+            return False
+        return value is self.value or (self._same is not None and self._same(self.value, value))
@@ -0,0 +1,57 @@
+import copy
+import hashlib
+import threading
+from collections import OrderedDict
+import pandas as pd
+import streamlit as st
+# Altair charts are serialised the way st.altair_chart does it (streamlit is pinned in requirements.txt)
+from streamlit.elements.vega_charts import _convert_altair_to_vega_lite_spec
+
+# Serialised chart specs and figures kept, the least recently used ones are dropped first
+CHART_CACHE_SIZE = 256
+
+
+def fingerprint(df):
+    # Fast hash of the values, column names and dtypes of an aggregated frame
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    digest.update(repr([(str(column), str(dtype)) for column, dtype in df.dtypes.items()]).encode('utf-8'))
+    return digest.hexdigest()
+
+# Charts shared by every session, keyed by chart, parameters and data fingerprint
+class ChartCache:
+    def __init__(self):
+        self._charts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        with self._lock:
+            if key in self._charts:
+                self._charts.move_to_end(key)
+                return self._charts[key]
+        chart = build()
+        with self._lock:
+            self._charts[key] = chart
+            while len(self._charts) > CHART_CACHE_SIZE:
+                self._charts.popitem(last=False)
+        return chart
+
+@st.cache_resource
+def get_chart_cache():
+    return ChartCache()
+
+def _key(name, data, params):
+    return (name, fingerprint(data), repr(params))
+
+def altair_chart(name, data, build, params=(), **kwargs):
+    # Show the Altair chart build(data) makes. name identifies the chart and params holds every
+    # other input of build (titles, formats, ...); when neither they nor the data changed, the
+    # serialised Vega-Lite spec of the last run is sent again without building the chart.
+    spec = get_chart_cache().get(_key(name, data, params), lambda: _convert_altair_to_vega_lite_spec(build(data)))
+    # Streamlit pops the datasets off the spec it is given
+    return st.vega_lite_chart(spec=copy.copy(spec), **kwargs)
+
+def plotly_chart(name, data, build, params=(), **kwargs):
+    # Show the Plotly figure build(data) makes, reusing the figure while name, params and data are unchanged
+    figure = get_chart_cache().get(_key(name, data, params), lambda: build(data))
+    return st.plotly_chart(figure, **kwargs)
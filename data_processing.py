@@ -1,47 +1,382 @@
+import datetime
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
+import numpy as np
 import pandas as pd
-from fetch_data import fetch_data_discovery, fetch_data_sap
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from cache_policy import CachedLoader
+from fetch_data import (DISCOVERY_TIMEOUT, ROW_KEY, discovery_appended, fetch_data_discovery, fetch_data_sap,
+                        fetch_kpi_aggregate, request_full_refresh)
+from snapshot import load_snapshot, save_snapshot
+
+# Columns returned by query_discovery.sql
+DISCOVERY_COLUMNS = ['email', 'name', 'phone', 'Register Date', 'Test Date', 'bundle_name', 'Test Name', 'typology',
+                     'total_score', 'final_result', 'Province', 'Institution', 'Company', 'Last Education',
+                     'Customer ID', 'Result ID', 'Bundle Result ID']
+
+# Columns kept from the SAP sheet
+SAP_COLUMNS = ['name_sap', 'email', 'nik', 'unit', 'subunit', 'admin_hr', 'layer', 'generation', 'gender', 'division', 'department']
+
+# Seconds each source may take on a cold start before it is reported as unavailable
+SOURCE_TIMEOUTS = {'Discovery': DISCOVERY_TIMEOUT, 'SAP': 180}
+
+# dtype of every column in merged_df. Low-cardinality text is stored as categoricals, dates as
+# datetime64 and IDs as compact integers or Arrow strings. Pages must group categoricals with
+# observed=True so unused categories don't show up as empty groups.
+MERGED_SCHEMA = {
+    'email': 'string[pyarrow]',
+    'name': 'string[pyarrow]',
+    'phone': 'string[pyarrow]',
+    'Register Date': 'datetime64[ns]',
+    'Test Date': 'datetime64[ns]',
+    'bundle_name': 'category',
+    'Test Name': 'category',
+    'typology': 'category',
+    'total_score': 'float64',
+    'final_result': 'category',
+    'Province': 'category',
+    'Institution': 'category',
+    'Company': 'category',
+    'Last Education': 'category',
+    'Customer ID': 'Int32',
+    'Result ID': 'int64',
+    'Bundle Result ID': 'int64',
+    'name_sap': 'string[pyarrow]',
+    'nik': 'string[pyarrow]',
+    'unit': 'category',
+    'subunit': 'category',
+    'admin_hr': 'category',
+    'layer': 'category',
+    'generation': 'category',
+    'gender': 'category',
+    'division': 'category',
+    'department': 'category',
+    'status': 'category',
+}
+
+# Seconds before a loaded source is revalidated in the background,
+# overridable with discovery_ttl / sap_ttl in st.secrets["cache"]
+CACHE_TTLS = {'Discovery': 900, 'SAP': 3600}
+
+# Frames returned by finalize_data, in order, and persisted in every snapshot
+SNAPSHOT_FRAMES = ('discovery', 'sap', 'merged')
+
+# Group-by columns returned by each KPI aggregate query, besides status and users
+KPI_COLUMNS = {'status': [], 'day': ['Test Date'], 'bundle': ['bundle_name'], 'test': ['bundle_name', 'Test Name', 'typology']}
+
+# KPI aggregates kept, the least recently used ones are dropped first
+KPI_CACHE_SIZE = 64
+
+# First day of the date windows while the raw rows, and so their date range, aren't loaded
+HEADLINE_START = datetime.date(2023, 1, 1)
+
+logger = logging.getLogger(__name__)
+
+def _ttl(source):
+    try:
+        return st.secrets["cache"][f"{source.lower()}_ttl"]
+    except (KeyError, FileNotFoundError):
+        return CACHE_TTLS[source]
+
+def _load_sap():
+    # Fetch SAP data with selected columns
+    df_sap = fetch_data_sap(SAP_COLUMNS)
+    return clean_sap_data(df_sap)
+
+@st.cache_resource
+def _discovery_loader():
+    return CachedLoader('Discovery', fetch_data_discovery, _ttl('Discovery'), on_update=_rebuild_dataset)
+
+@st.cache_resource
+def _sap_loader():
+    # The sheet is read again from its mirror when it didn't change, compare the contents
+    return CachedLoader('SAP', _load_sap, _ttl('SAP'), on_update=_rebuild_dataset, same=pd.DataFrame.equals)
 
-@st.cache_data
 def fetch_discovery_data():
     # Fetch data from Discovery
-    df_discovery = fetch_data_discovery()
-    return df_discovery
+    return _discovery_loader().get()
 
-@st.cache_data
 def fetch_sap_data():
-    # Fetch SAP data with selected columns
-    selected_columns = ['name_sap', 'email', 'nik', 'unit', 'subunit', 'admin_hr', 'layer', 'generation', 'gender', 'division', 'department']
-    df_sap = fetch_data_sap(selected_columns)
-    df_sap = clean_sap_data(df_sap)
-    return df_sap
+    return _sap_loader().get()
+
+def refresh_data():
+    # Manual "refresh now": both sources reload in the background while the current data is
+    # served, Discovery with a full rebuild
+    request_full_refresh()
+    _discovery_loader().refresh()
+    _sap_loader().refresh()
 
 def clean_sap_data(df_sap):
     df_sap['email'] = df_sap['email'].str.strip().str.lower()
     df_sap['nik'] = df_sap['nik'].astype(str).str.zfill(6)
     return df_sap
 
-@st.cache_data
-def finalize_data():
-    # Fetch and clean data from Discovery and SAP
-    df_discovery = fetch_discovery_data()
-    df_sap = fetch_sap_data()
+def load_sources():
+    # Load Discovery and SAP concurrently. A source that fails or runs past its timeout
+    # is reported and replaced by an empty frame, so the other source is still served.
+    # A source whose first load is still running (e.g. after an earlier timeout) isn't
+    # waited for again, it is reported as loading and replaced by an empty frame as well.
+    loaders = {'Discovery': _discovery_loader(), 'SAP': _sap_loader()}
+    empty_frames = {'Discovery': pd.DataFrame(columns=DISCOVERY_COLUMNS), 'SAP': pd.DataFrame(columns=SAP_COLUMNS)}
+
+    frames = {}
+    failed = []
+    for source, loader in loaders.items():
+        if loader.loading and not loader.loaded:
+            message = f"Data from {source} is still loading and is shown once the load finishes."
+            logger.warning(message)
+            st.warning(message)
+            frames[source] = empty_frames[source]
+            failed.append(source)
+    idle = {source: loader for source, loader in loaders.items() if source not in failed}
+
+    # Worker threads share the script context so cached loaders and st.* calls keep working
+    executor = ThreadPoolExecutor(max_workers=len(loaders), initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx()))
+    started = time.monotonic()
+    futures = {source: executor.submit(loader.get) for source, loader in idle.items()}
+
+    for source, future in futures.items():
+        remaining = SOURCE_TIMEOUTS[source] - (time.monotonic() - started)
+        try:
+            frames[source] = future.result(timeout=max(remaining, 0))
+            continue
+        except TimeoutError:
+            message = f"Fetching data from {source} timed out after {SOURCE_TIMEOUTS[source]} seconds."
+        except Exception as e:
+            message = f"An error occurred while fetching data from {source}: {e}"
+        logger.error(message)
+        st.error(message)
+        frames[source] = empty_frames[source]
+        failed.append(source)
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    return frames['Discovery'], frames['SAP'], failed
+
+def merge_sources(df_discovery, df_sap):
+    # Loaders share their frames, so work on a copy
+    df_discovery = df_discovery.copy()
 
     # Clean Discovery email
     df_discovery['email'] = df_discovery['email'].str.strip().str.lower()
 
     if 'Register Date' in df_discovery.columns:
-        df_discovery['Register Date'] = pd.to_datetime(df_discovery['Register Date'], errors='coerce').dt.date
+        df_discovery['Register Date'] = pd.to_datetime(df_discovery['Register Date'], errors='coerce').dt.normalize()
         df_discovery = df_discovery.dropna(subset=['Register Date'])
-        
-    # Convert Test Date to timestamp and extract date
+
+    # Convert Test Date to timestamp and truncate it to the day
     if 'Test Date' in df_discovery.columns:
-        df_discovery['Test Date'] = pd.to_datetime(df_discovery['Test Date'], errors='coerce').dt.date
+        df_discovery['Test Date'] = pd.to_datetime(df_discovery['Test Date'], errors='coerce').dt.normalize()
         df_discovery = df_discovery.dropna(subset=['Test Date'])
 
     # Merge Discovery data with SAP data based on email
-    merged_df = pd.merge(df_discovery, df_sap, on='email', how='left', indicator=True)
-    merged_df['status'] = merged_df['_merge'].apply(lambda x: 'Internal' if x == 'both' else 'External')
-    merged_df.drop(columns=['_merge'], inplace=True)
+    merged_df, fan_out = join_employees(df_discovery, df_sap)
+    if fan_out['duplicate_emails']:
+        logger.warning("%d emails occur more than once in SAP and add %d extra test rows: %s",
+                       len(fan_out['duplicate_emails']), fan_out['extra_rows'], ', '.join(fan_out['duplicate_emails'][:10]))
+
+    # Normalise IDs once per data version instead of on every page load
+    merged_df['nik'] = merged_df['nik'].str.replace(',', '', regex=False)
+
+    return df_discovery, df_sap, apply_schema(merged_df)
+
+def join_employees(df_discovery, df_sap):
+    # Left join of Discovery on SAP by email, same rows and order as pd.merge(how='left').
+    # Both email columns are factorised into integer keys in one hash pass, SAP first, so
+    # every key below the number of SAP emails is an employee; the rest of the join is
+    # integer array work that stays linear in the number of test rows.
+    # Returns the joined frame with a status column and a report of duplicate SAP emails,
+    # each of which repeats the matching test rows once per SAP row.
+    codes, emails = pd.factorize(pd.concat([df_sap['email'], df_discovery['email']], ignore_index=True))
+    sap_codes, keys = codes[:len(df_sap)], codes[len(df_sap):]
+    sap_key_count = sap_codes.max() + 1 if (sap_codes >= 0).any() else 0
+    matched = (keys >= 0) & (keys < sap_key_count)
+
+    # SAP rows grouped by key, in sheet order within each key
+    rows_per_key = np.bincount(sap_codes[sap_codes >= 0], minlength=sap_key_count)
+    sap_order = np.argsort(sap_codes, kind='stable')[np.count_nonzero(sap_codes < 0):]
+    key_starts = np.cumsum(rows_per_key) - rows_per_key
+
+    # Every Discovery row is repeated once per matching SAP row, or kept once without a match
+    repeats = np.ones(len(keys), dtype=np.int64)
+    repeats[matched] = rows_per_key[keys[matched]]
+    right = np.full(int(repeats.sum()), -1, dtype=np.int64)
+    if len(right) == len(keys):
+        left, hits = None, matched
+        right[hits] = sap_order[key_starts[keys[hits]]]
+        discovery_rows = df_discovery.reset_index(drop=True)
+    else:
+        left = np.repeat(np.arange(len(keys)), repeats)
+        offsets = np.arange(len(left)) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+        hits = matched[left]
+        right[hits] = sap_order[key_starts[keys[left[hits]]] + offsets[hits]]
+        discovery_rows = df_discovery.iloc[left].reset_index(drop=True)
+
+    employees = df_sap.drop(columns=['email']).reset_index(drop=True).reindex(right).reset_index(drop=True)
+    merged_df = pd.concat([discovery_rows, employees], axis=1)
+    merged_df['status'] = pd.Categorical.from_codes(hits.astype(np.int8), categories=['External', 'Internal'])
+
+    fan_out = {
+        'duplicate_emails': [str(email) for email in emails[:sap_key_count][rows_per_key > 1]],
+        'extra_rows': int(len(right) - len(keys)),
+    }
+    return merged_df, fan_out
+
+def apply_schema(df):
+    df = df.astype({column: dtype for column, dtype in MERGED_SCHEMA.items() if column in df.columns})
+    # Discovery text arrives as Arrow strings, categories are kept as plain objects like the SAP ones
+    for column in df.columns:
+        if isinstance(df[column].dtype, pd.CategoricalDtype) and isinstance(df[column].cat.categories.dtype, pd.StringDtype):
+            df[column] = df[column].cat.rename_categories(df[column].cat.categories.astype(object))
+    return df
+
+def memory_report(df):
+    # Deep memory usage per column, largest first
+    usage = df.memory_usage(deep=True, index=False)
+    report = pd.DataFrame({'column': usage.index, 'dtype': df.dtypes.astype(str).values, 'MB': (usage.values / 2**20).round(2)})
+    report['share'] = (report['MB'] / report['MB'].sum() * 100).round(1)
+    return report.sort_values('MB', ascending=False).reset_index(drop=True)
+
+# One typed version of the merged data, shared read-only by every page and session.
+# Frames must never be modified in place; pages filter or copy them instead. Structures
+# derived from the data (indexes, rollups, ...) are built once per version with derived().
+# changes describes how merged differs from the merged frame of the previous version when
+# only Discovery was refreshed incrementally, so structures can be extended instead of
+# rebuilt: {'previous': version, 'replaced': positions of the previous rows that are gone,
+# 'appended': number of rows at the end of merged}. The other rows are the previous ones,
+# unchanged and in order. None when the version isn't such a refresh.
+class Dataset:
+    def __init__(self, discovery, sap, merged, version, changes=None):
+        self.discovery = discovery
+        self.sap = sap
+        self.merged = merged
+        self.version = version
+        self.changes = changes
+        self._derived = {}
+        # Reentrant, a structure may be built from other derived structures
+        self._lock = threading.RLock()
+
+    def derived(self, name, build):
+        with self._lock:
+            if name not in self._derived:
+                self._derived[name] = build(self)
+            return self._derived[name]
+
+# The dataset currently served, replaced as a whole whenever a source refreshes
+@st.cache_resource
+def _dataset_state():
+    return {'dataset': None, 'sources': None, 'discovery': None, 'partial': None, 'lock': threading.Lock()}
+
+def _key_hashes(df):
+    return pd.util.hash_pandas_object(df[ROW_KEY].astype('int64'), index=False).to_numpy()
+
+def _changes(previous, merged, appended):
+    # Dataset.changes of merged against the Dataset previous, when the Discovery frame of merged
+    # is the one of previous with the rows appended to its end (same SAP data). A re-fetched
+    # result replaces every previous row with its ROW_KEY; None when the rows don't line up.
+    previous_keys = _key_hashes(previous.merged)
+    replaced = np.flatnonzero(np.isin(previous_keys, _key_hashes(appended)))
+    kept = len(previous_keys) - len(replaced)
+    if kept > len(merged) or not np.array_equal(np.delete(previous_keys, replaced), _key_hashes(merged.iloc[:kept])):
+        return None
+    return {'previous': previous.version, 'replaced': replaced, 'appended': len(merged) - kept}
+
+def _rebuild_dataset():
+    discovery, sap = _discovery_loader(), _sap_loader()
+    if not (discovery.loaded and sap.loaded):
+        return
+    state = _dataset_state()
+    try:
+        with state['lock']:
+            sources = (discovery.version, sap.version)
+            if state['sources'] == sources:
+                return
+            data = merge_sources(discovery.value, sap.value)
+            changes = None
+            previous = state['dataset']
+            if previous is not None and state['sources'][1] == sap.version:
+                appended = discovery_appended(state['discovery'], discovery.value)
+                if appended is not None:
+                    changes = _changes(previous, data[2], discovery.value.iloc[len(discovery.value) - appended:])
+            state['dataset'] = Dataset(*data, version=f"live-{discovery.version}.{sap.version}", changes=changes)
+            state['sources'] = sources
+            state['discovery'] = discovery.value
+        logger.info("Merged dataset rebuilt: %d rows, %.1f MB", len(data[2]), memory_report(data[2])['MB'].sum())
+    except Exception as e:
+        logger.error("Rebuilding the merged dataset failed, keeping the last good one: %s", e)
+        return
+    try:
+        save_snapshot(dict(zip(SNAPSHOT_FRAMES, data)))
+    except OSError as e:
+        logger.warning("Could not write the data snapshot: %s", e)
+
+def _partial_dataset(df_discovery, df_sap):
+    # Dataset of the sources that did load, reused until either source loads a new version
+    state = _dataset_state()
+    version = f"partial-{_discovery_loader().version}.{_sap_loader().version}"
+    with state['lock']:
+        if state['partial'] is None or state['partial'].version != version:
+            state['partial'] = Dataset(*merge_sources(df_discovery, df_sap), version=version)
+        return state['partial']
+
+@st.cache_resource
+def _startup_snapshot():
+    snapshot = load_snapshot()
+    if snapshot is None:
+        return None
+    frames, manifest = snapshot
+    return Dataset(*(frames[name] for name in SNAPSHOT_FRAMES), version=manifest['version'])
+
+def get_dataset(wait=True):
+    # Served from the current dataset; stale sources are revalidated in the background.
+    # A fresh server comes up from the newest on-disk snapshot while the sources load, and
+    # only without either does the first caller wait for the sources. With wait=False None
+    # is returned instead, so a page can show headline numbers from kpi_summary() and load
+    # the raw rows on demand.
+    state = _dataset_state()
+    dataset = state['dataset']
+    if dataset is not None:
+        fetch_discovery_data()
+        fetch_sap_data()
+    elif _startup_snapshot() is not None:
+        dataset = _startup_snapshot()
+        for loader in (_discovery_loader(), _sap_loader()):
+            if not loader.loaded:
+                loader.refresh()
+    elif not wait:
+        return None
+    else:
+        df_discovery, df_sap, failed = load_sources()
+        dataset = state['dataset']
+        if failed or dataset is None:
+            dataset = _partial_dataset(df_discovery, df_sap)
+    return dataset
+
+def finalize_data():
+    dataset = get_dataset()
+    return dataset.discovery, dataset.sap, dataset.merged
+
+# Aggregates are revalidated as often as Discovery itself
+@st.cache_data(ttl=CACHE_TTLS['Discovery'], max_entries=KPI_CACHE_SIZE, show_spinner=False)
+def _kpi_summary(grouping, test_window, register_window, versions):
+    # versions only keys the cache, a reloaded source starts new entries
+    internal_emails = fetch_sap_data()['email'].dropna().unique().tolist()
+    df = fetch_kpi_aggregate(grouping, test_window, register_window, internal_emails)
+    if df.empty:
+        df = pd.DataFrame(columns=KPI_COLUMNS[grouping] + ['status', 'users'])
+    df['users'] = df['users'].astype(int)
+    return df
 
-    return df_discovery, df_sap, merged_df
+def kpi_summary(grouping, test_window, register_window):
+    # Distinct Customer ID counts per status (and the KPI_COLUMNS of grouping) for inclusive
+    # Test Date and Register Date windows, computed in MySQL so headline numbers don't need the
+    # raw rows. Entries are keyed by the source versions, so a reload (e.g. by refresh_data())
+    # replaces them once it finishes. Returns None when the aggregate query fails.
+    versions = (_discovery_loader().version, _sap_loader().version)
+    try:
+        return _kpi_summary(grouping, tuple(test_window), tuple(register_window), versions)
+    except Exception as e:
+        logger.warning("KPI aggregate '%s' failed: %s", grouping, e)
+        return None
@@ -0,0 +1,86 @@
+import queue
+import threading
+import time
+from contextlib import contextmanager
+import pymysql
+
+
+# A small thread-safe pool of MySQL connections.
+# Connections are pinged before every checkout, replaced once they exceed max_lifetime
+# and discarded instead of reused when the caller raises while holding one.
+# query_timeout bounds every socket read and write; statement_timeout (query_timeout when
+# None) bounds a whole SELECT on the server, including the time its rows are streamed.
+class ConnectionPool:
+    def __init__(self, connect_kwargs, size=4, max_lifetime=3600, query_timeout=300, checkout_timeout=30, statement_timeout=None):
+        self.connect_kwargs = connect_kwargs
+        self.size = size
+        self.max_lifetime = max_lifetime
+        self.query_timeout = query_timeout
+        self.statement_timeout = query_timeout if statement_timeout is None else statement_timeout
+        self.checkout_timeout = checkout_timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _open(self):
+        # autocommit keeps a reused connection from holding on to an old read snapshot
+        conn = pymysql.connect(
+            autocommit=True,
+            read_timeout=self.query_timeout,
+            write_timeout=self.query_timeout,
+            **self.connect_kwargs,
+        )
+        try:
+            # Server-side limit for SELECT statements, not available on every MySQL flavour
+            with conn.cursor() as cursor:
+                cursor.execute("SET SESSION MAX_EXECUTION_TIME = %s", (int(self.statement_timeout * 1000),))
+        except pymysql.err.MySQLError:
+            pass
+        return conn, time.monotonic()
+
+    def _is_healthy(self, entry):
+        conn, created_at = entry
+        if time.monotonic() - created_at > self.max_lifetime:
+            return False
+        try:
+            conn.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, entry):
+        try:
+            entry[0].close()
+        except Exception:
+            pass
+
+    def _checkout(self):
+        while True:
+            try:
+                entry = self._idle.get_nowait()
+            except queue.Empty:
+                return self._open()
+            if self._is_healthy(entry):
+                return entry
+            self._discard(entry)
+
+    @contextmanager
+    def connection(self):
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            raise TimeoutError(f"No database connection became available within {self.checkout_timeout} seconds")
+        try:
+            entry = self._checkout()
+            try:
+                yield entry[0]
+            except BaseException:
+                self._discard(entry)
+                raise
+            self._idle.put(entry)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                return
@@ -0,0 +1,171 @@
+import logging
+import threading
+import weakref
+import numpy as np
+import pandas as pd
+import streamlit as st
+from filter_index import FilterIndex, extend_codes
+from search_index import SearchIndex
+
+# Dimensions the dashboard counts distinct customers by, or filters on before counting.
+# Every distinct combination of them with a Customer ID is one cell of the cube.
+CUBE_DIMENSIONS = ['name', 'nik', 'status', 'gender', 'generation', 'layer', 'unit', 'subunit', 'Province', 'Company',
+                   'Institution', 'Last Education', 'Register Date', 'Test Date', 'bundle_name']
+
+logger = logging.getLogger(__name__)
+
+
+def _row_hashes(df):
+    # Hash of the cell every row of df falls in
+    return pd.util.hash_pandas_object(df[['Customer ID'] + CUBE_DIMENSIONS], index=False).to_numpy()
+
+def _distinct(hashes):
+    # Positions of the first row of every distinct hash in row order, and the cell (rank among
+    # those first rows) of every row
+    _, first, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    return first[order], rank[inverse.ravel()]
+
+def _recode(cells, dtypes):
+    # cells with the categories of dtypes, the codes of held values follow the new categories
+    changed = {column: cells[column].cat.set_categories(dtypes[column].categories) for column in cells.columns
+               if isinstance(dtypes[column], pd.CategoricalDtype) and not cells[column].cat.categories.equals(dtypes[column].categories)}
+    return cells.assign(**changed) if changed else cells
+
+def _sort_codes(column):
+    # Integer codes ordered like groupby orders the values, -1 for missing values
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column.cat.codes.to_numpy().astype(np.int64), column.cat.categories
+    codes, values = pd.factorize(column, sort=True)
+    return codes.astype(np.int64), pd.Index(values)
+
+def distinct_counts(keys, customers):
+    # Sorted distinct group keys and the number of distinct customers (codes >= 0) in each
+    groups, inverse = np.unique(keys, return_inverse=True)
+    counted = customers >= 0
+    width = customers.max(initial=0) + 2
+    pairs = np.unique(inverse[counted].astype(np.int64) * width + customers[counted])
+    return groups, np.bincount(pairs // width, minlength=len(groups))
+
+# Exact distinct Customer ID counts over the dashboard dimensions, answered from the distinct
+# cells of the data instead of its raw rows. The cells are indexed like merged_df, so a slice
+# (or a union of values per dimension) resolves to a bitmap of cells, and the distinct customers
+# in it are counted in total or per value of one or more dimensions.
+# The cube knows the cell of every row of its data version, so a version that replaces and
+# appends rows (see Dataset.changes) only hashes the appended rows, adds the cells not held yet
+# after the held ones and extends the indexes and customer codes over them.
+class DistinctCube:
+    def __init__(self, cells, hashes, row_cells, sap, version, previous=None):
+        self.cells = cells
+        self.sap = sap
+        self.version = version
+        # Weak reference to the cube this one was extended from, its cells are the first cells of this one
+        self.extends = weakref.ref(previous) if previous is not None else None
+        self._hashes = hashes
+        self._row_cells = row_cells
+        self._hash_order = np.argsort(hashes)
+        self._sorted_hashes = hashes[self._hash_order]
+        if previous is None:
+            customers, self._customer_ids = pd.factorize(cells['Customer ID'])
+        else:
+            held = len(previous.cells)
+            customers, self._customer_ids = extend_codes(previous.customers, previous._customer_ids, cells['Customer ID'].iloc[held:])
+        self.customers = customers.astype(np.int64)
+        self._index = FilterIndex(cells, previous=previous._index if previous is not None else None)
+        self._search = SearchIndex(cells, previous=previous._search if previous is not None else None)
+        self._codes = {}
+
+    @classmethod
+    def build(cls, dataset):
+        merged = dataset.merged
+        hashes = _row_hashes(merged)
+        first, row_cells = _distinct(hashes)
+        cells = merged[['Customer ID'] + CUBE_DIMENSIONS].take(first).reset_index(drop=True)
+        return cls(cells, hashes[first], row_cells, dataset.sap, dataset.version)
+
+    def extend(self, dataset):
+        # Cube of dataset from this one when dataset only replaces and appends rows of the version
+        # this cube was built for (see Dataset.changes, same SAP data) and every held cell keeps
+        # rows. A re-fetched result whose attributes changed, or a removed one, leaving a cell
+        # without rows forces a full build. Returns None when a full build is needed.
+        changes = dataset.changes
+        if changes is None or changes['previous'] != self.version or dataset.sap is not self.sap:
+            return None
+        merged = dataset.merged
+        start = len(merged) - changes['appended']
+        hashes = _row_hashes(merged.iloc[start:])
+
+        # Appended rows of held cells, found by binary search on the sorted cell hashes
+        positions = np.minimum(np.searchsorted(self._sorted_hashes, hashes), max(len(self._sorted_hashes) - 1, 0))
+        held = self._sorted_hashes[positions] == hashes if len(self._sorted_hashes) else np.zeros(len(hashes), dtype=bool)
+        new_rows = np.flatnonzero(~held)
+        first, new_cells = _distinct(hashes[new_rows])
+        appended_cells = np.empty(len(hashes), dtype=np.int64)
+        appended_cells[held] = self._hash_order[positions[held]]
+        appended_cells[new_rows] = len(self.cells) + new_cells
+
+        row_cells = np.concatenate([np.delete(self._row_cells, changes['replaced']), appended_cells])
+        if not np.bincount(row_cells, minlength=len(self.cells))[:len(self.cells)].all():
+            return None
+        added = merged.iloc[start:][['Customer ID'] + CUBE_DIMENSIONS].take(new_rows[first])
+        cells = pd.concat([_recode(self.cells, merged.dtypes), added], ignore_index=True)
+        return DistinctCube(cells, np.concatenate([self._hashes, hashes[new_rows[first]]]), row_cells, dataset.sap, dataset.version, previous=self)
+
+    def _sorted_codes(self, column):
+        if column not in self._codes:
+            self._codes[column] = _sort_codes(self.cells[column])
+        return self._codes[column]
+
+    def select(self, filters=None, dates=None, name=None):
+        # Cells of the rows passing filters and dates (see FilterIndex.select) whose name contains name
+        masks = [self._search.search('name', name)] if name else []
+        return self._index.select(filters, dates, masks)
+
+    def count(self, filters=None, dates=None, name=None, by=None):
+        # Distinct Customer IDs among the rows passing filters and dates whose name contains name.
+        # Without by the total is returned, otherwise a frame like
+        # df.groupby(by)['Customer ID'].nunique().reset_index().
+        cells = self.select(filters, dates, name)
+        customers = self.customers[cells]
+        if not by:
+            return len(np.unique(customers[customers >= 0]))
+
+        # One group key per cell from the codes of the by columns, groups with a missing value are dropped
+        keys = np.zeros(len(cells), dtype=np.int64)
+        present = np.ones(len(cells), dtype=bool)
+        decoded = []
+        for column in by:
+            codes, values = self._sorted_codes(column)
+            codes = codes[cells]
+            present &= codes >= 0
+            keys = keys * (len(values) + 1) + codes + 1
+            decoded.append((column, codes, values))
+        groups, counts = distinct_counts(keys[present], customers[present])
+
+        first = np.unique(keys[present], return_index=True)[1]
+        result = pd.DataFrame({column: values.take(codes[present][first]) for column, codes, values in decoded})
+        result['Customer ID'] = counts
+        return result
+
+# The last cube built, so the next data version can extend it instead of starting over
+@st.cache_resource
+def _cube_state():
+    return {'cube': None, 'lock': threading.Lock()}
+
+def _build_cube(dataset):
+    state = _cube_state()
+    with state['lock']:
+        cube = state['cube'].extend(dataset) if state['cube'] is not None else None
+        if cube is not None:
+            logger.info("Distinct-count cube extended: %d cells, %d new, from %d appended rows",
+                        len(cube.cells), len(cube.cells) - len(state['cube'].cells), dataset.changes['appended'])
+        else:
+            cube = DistinctCube.build(dataset)
+            logger.info("Distinct-count cube built: %d cells from %d rows", len(cube.cells), len(dataset.merged))
+        state['cube'] = cube
+    return cube
+
+def get_distinct_cube(dataset):
+    return dataset.derived('distinct_cube', _build_cube)
@@ -0,0 +1,88 @@
+import io
+import threading
+from collections import OrderedDict
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pandas as pd
+import streamlit as st
+
+# File extension and MIME type per export format, the first is the default
+EXPORT_FORMATS = {
+    'CSV': ('csv', 'text/csv'),
+    'Parquet': ('parquet', 'application/vnd.apache.parquet'),
+    'XLSX': ('xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+}
+
+# Rows written per chunk, so an export never holds a second full text copy of the frame
+EXPORT_CHUNK_ROWS = 50000
+
+# Exports kept per data version, the least recently used ones are dropped first
+EXPORT_CACHE_SIZE = 32
+
+
+def _chunks(df):
+    for start in range(0, max(len(df), 1), EXPORT_CHUNK_ROWS):
+        yield start, df.iloc[start:start + EXPORT_CHUNK_ROWS]
+
+def _csv_bytes(df):
+    buffer = io.BytesIO()
+    for start, chunk in _chunks(df):
+        buffer.write(chunk.to_csv(index=False, header=start == 0).encode('utf-8'))
+    return buffer.getvalue()
+
+def _parquet_bytes(df):
+    buffer = io.BytesIO()
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    with pq.ParquetWriter(buffer, schema) as writer:
+        for _, chunk in _chunks(df):
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+    return buffer.getvalue()
+
+def _xlsx_bytes(df):
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+        for start, chunk in _chunks(df):
+            chunk.to_excel(writer, index=False, header=start == 0, startrow=start + 1 if start else 0)
+    return buffer.getvalue()
+
+EXPORT_WRITERS = {'CSV': _csv_bytes, 'Parquet': _parquet_bytes, 'XLSX': _xlsx_bytes}
+
+# Export files of one data version by (name, filter state, format), built on first request
+class ExportCache:
+    def __init__(self):
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._files:
+                self._files.move_to_end(key)
+            return self._files.get(key)
+
+    def put(self, key, data):
+        with self._lock:
+            self._files[key] = data
+            while len(self._files) > EXPORT_CACHE_SIZE:
+                self._files.popitem(last=False)
+
+def get_export_cache(dataset):
+    return dataset.derived('exports', lambda dataset: ExportCache())
+
+# Download of df (derived from dataset under the filter state state, e.g. the repr of the page
+# filters) in a chosen format. The file is only written when the user asks for it and is then
+# kept for the same data version and filters, so reruns don't export anything.
+def show_download(dataset, state, df, name, label, help, key):
+    fmt = st.selectbox("Format", list(EXPORT_FORMATS), key=f'{key}_format')
+    extension, mime = EXPORT_FORMATS[fmt]
+    cache = get_export_cache(dataset)
+    cache_key = (name, state, fmt)
+    data = cache.get(cache_key)
+    if data is None and st.button(f"Prepare {fmt} file", key=f'{key}_prepare'):
+        try:
+            data = EXPORT_WRITERS[fmt](df)
+        except ImportError as e:
+            st.error(f"{fmt} export is not available: {e}")
+            return
+        cache.put(cache_key, data)
+    if data is not None:
+        st.download_button(label, data=data, file_name=f"{name}.{extension}", mime=mime, help=help, key=f'{key}_download')
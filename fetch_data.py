@@ -1,4 +1,11 @@
-#import streamlit as st
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+import streamlit as st
 import pandas as pd
 import pymysql
 from sshtunnel import SSHTunnelForwarder
@@ -7,45 +14,289 @@ from io import StringIO
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 import toml
+from db_pool import ConnectionPool
 
 
-# Function to connect to Discovery directly and fetch data
+# Only result rows past the stored high-water mark are fetched on an incremental refresh.
+# Rows created at the watermark itself are fetched again and replace the held copies,
+# so results written within the same second are never missed. Each condition is its own
+# SELECT of a UNION, so MySQL can use the index of its table instead of scanning the join.
+INCREMENTAL_CONDITIONS = ["ubr.created_at >= %(since)s", "ur.id > %(last_result_id)s"]
+
+# A UNION can only be ordered by the names of its output columns
+INCREMENTAL_ORDER_BY = "bundle_name ASC, name ASC, `Test Date` DESC, total_score DESC"
+
+# A Discovery row is one result within one bundle result, a result can be part of several
+ROW_KEY = ['Result ID', 'Bundle Result ID']
+
+# Seconds between full rebuilds, which pick up deleted results and changed user and
+# customer fields that incremental refreshes never see
+FULL_REFRESH_INTERVAL = 24 * 3600
+
+# Seconds a Discovery load may take on a cold start, streaming included. It also bounds
+# every statement on the server, so MySQL never stops a load the app is still waiting for.
+DISCOVERY_TIMEOUT = 600
+
+# Rows are streamed from a server-side cursor in chunks of this size
+CHUNK_SIZE = 10000
+
+# Typed decoding for Discovery columns, everything else is decoded as Arrow strings
+DISCOVERY_COLUMN_TYPES = {
+    'Register Date': 'datetime',
+    'Test Date': 'datetime',
+    'total_score': 'float64',
+    'Customer ID': 'Int64',
+    'Result ID': 'int64',
+    'Bundle Result ID': 'int64',
+}
+
+# Pre-aggregated variants of query_discovery.sql, each parameterised by a date window
+KPI_QUERIES = {
+    'status': 'query_discovery_status.sql',
+    'day': 'query_discovery_day.sql',
+    'bundle': 'query_discovery_bundle.sql',
+    'test': 'query_discovery_test.sql',
+}
+
+# Local mirror of the SAP sheet, tagged with the spreadsheet's Drive modified time
+CACHE_DIR = os.environ.get('DISCOVERY_CACHE_DIR', '.cache')
+SAP_SPREADSHEET = '0. Active Employee - Monthly Updated'
+SAP_MIRROR_FILE = os.path.join(CACHE_DIR, 'sap_active_employee.parquet')
+SAP_MIRROR_META = os.path.join(CACHE_DIR, 'sap_active_employee.json')
+
+logger = logging.getLogger(__name__)
+
+
+# Holds the Discovery dataset and its high-water mark across cache rebuilds
+@st.cache_resource
+def _discovery_store():
+    # 'appended' records the last incremental refresh as weak references to the frame it started
+    # from and the frame it returned, and the number of rows it appended
+    return {'df': None, 'watermark': None, 'stats': None, 'rebuilt_at': None, 'appended': None, 'lock': threading.Lock()}
+
+# Connection pool shared by every session and thread; sizing and socket timeouts can be
+# tuned with pool_size, pool_max_lifetime and query_timeout in st.secrets["discovery"]
 @st.cache_resource
-def fetch_data_discovery():
+def _discovery_pool():
+    secrets = st.secrets["discovery"]
+    connection_kwargs = {
+        'host': secrets["host"],
+        'port': secrets["port"],
+        'user': secrets["user"],
+        'password': secrets["password"],
+        'database': secrets["database"],
+    }
+    return ConnectionPool(
+        connection_kwargs,
+        size=secrets.get("pool_size", 4),
+        max_lifetime=secrets.get("pool_max_lifetime", 3600),
+        query_timeout=secrets.get("query_timeout", 300),
+        statement_timeout=DISCOVERY_TIMEOUT,
+    )
+
+def _read_query(path='query_discovery.sql'):
+    with open(path, 'r') as sql_file:
+        return sql_file.read()
+
+def _incremental_query(query):
+    # One SELECT of the query file per incremental condition, without its trailing ORDER BY
+    body = query.rsplit('ORDER BY', 1)[0].rstrip()
+    selects = [f"({body}\nWHERE {condition})" for condition in INCREMENTAL_CONDITIONS]
+    return "\nUNION\n".join(selects) + f"\nORDER BY {INCREMENTAL_ORDER_BY}"
+
+def _decode_column(name, values):
+    kind = DISCOVERY_COLUMN_TYPES.get(name)
+    column = pd.Series(values, dtype=object)
+    if kind == 'datetime':
+        return pd.to_datetime(column, errors='coerce')
+    if kind is not None:
+        return pd.to_numeric(column, errors='coerce').astype(kind)
+    # Arrow buffers instead of one Python string object per value
+    return column.astype('string[pyarrow]')
+
+def _decode_chunk(rows, columns):
+    # Transpose the row tuples once and decode every column into a typed buffer
+    values = list(zip(*rows))
+    return pd.DataFrame({name: _decode_column(name, column) for name, column in zip(columns, values)})
+
+def _rss_mb():
+    # Current resident set size, None where /proc is not available
     try:
-        connection_kwargs = {
-            'host': st.secrets["discovery"]["host"],
-            'port': st.secrets["discovery"]["port"],
-            'user': st.secrets["discovery"]["user"],
-            'password': st.secrets["discovery"]["password"],
-            'database': st.secrets["discovery"]["database"],
-            'cursorclass': pymysql.cursors.DictCursor,
-        }
-        conn = pymysql.connect(**connection_kwargs)
-
-        with open('query_discovery.sql', 'r') as sql_file:
-            query = sql_file.read()
-
-        cursor = conn.cursor()
-        cursor.execute(query)
-        rows = cursor.fetchall()
+        with open('/proc/self/statm', 'r') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, IndexError):
+        return None
+
+def _run_query(query, params=None):
+    started = time.perf_counter()
+    # RSS is sampled after every chunk and after the concat, the largest sample is the peak of the fetch
+    rss_samples = [_rss_mb()]
+    with _discovery_pool().connection() as conn:
+        cursor = conn.cursor(pymysql.cursors.SSCursor)
+        cursor.execute(query, params)
+        columns = [column[0] for column in cursor.description]
+        chunks = []
+        while True:
+            rows = cursor.fetchmany(CHUNK_SIZE)
+            if not rows:
+                break
+            chunks.append(_decode_chunk(rows, columns))
+            rss_samples.append(_rss_mb())
         cursor.close()
-        conn.close()
-        return pd.DataFrame(rows)
-    except Exception as e:
-        st.error(f"An error occurred while fetching data from Discovery: {e}")
-        return pd.DataFrame()
 
-# Function to fetch data from SAP with selected columns
-@st.cache_resource
+    df = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=columns)
+    rss_samples.append(_rss_mb())
+    elapsed = time.perf_counter() - started
+    peak_rss = None if None in rss_samples else max(rss_samples)
+    stats = {
+        'rows': len(df),
+        'seconds': round(elapsed, 2),
+        'rows_per_sec': round(len(df) / elapsed) if elapsed > 0 else None,
+        'peak_rss_mb': None if peak_rss is None else round(peak_rss, 1),
+        'peak_rss_increase_mb': None if peak_rss is None else round(peak_rss - rss_samples[0], 1),
+    }
+    _discovery_store()['stats'] = stats
+    logger.info("Discovery fetch: %(rows)s rows in %(seconds)ss (%(rows_per_sec)s rows/sec, "
+                "peak RSS %(peak_rss_mb)s MB, %(peak_rss_increase_mb)s MB above the start)", stats)
+    return df
+
+def _watermark(df):
+    if df.empty or 'Result ID' not in df.columns:
+        return None
+    return {'since': df['Test Date'].max(), 'last_result_id': int(df['Result ID'].max())}
+
+def _same_rows(held, new_rows):
+    # Whether both frames hold the same rows, in any order
+    held = held.sort_values(ROW_KEY).reset_index(drop=True)
+    new_rows = new_rows.sort_values(ROW_KEY).reset_index(drop=True)
+    return held.equals(new_rows)
+
+def _append_rows(df, new_rows):
+    # Re-fetched results replace the copies already held, everything else is appended.
+    # When every fetched row is already held unchanged (the rows at the watermark are always
+    # fetched again) df itself is returned, so callers can tell nothing changed.
+    if new_rows.empty:
+        return df
+    refetched = pd.MultiIndex.from_frame(df[ROW_KEY]).isin(pd.MultiIndex.from_frame(new_rows[ROW_KEY]))
+    if refetched.sum() == len(new_rows) and _same_rows(df[refetched], new_rows):
+        return df
+    return pd.concat([df[~refetched], new_rows], ignore_index=True)
+
+def _fetch_incremental(df, watermark):
+    query = _incremental_query(_read_query())
+    new_rows = _run_query(query, watermark)
+    return _append_rows(df, new_rows), len(new_rows)
+
+def discovery_appended(previous, df):
+    # Number of rows the incremental refresh from the Discovery frame previous to df appended,
+    # after the rows of previous they didn't replace (see _append_rows). None when df isn't
+    # the last incremental refresh of previous, e.g. after a full rebuild.
+    appended = _discovery_store()['appended']
+    if appended is None:
+        return None
+    base, result, rows = appended
+    if base() is not previous or result() is not df:
+        return None
+    return rows
+
+def request_full_refresh():
+    # The next fetch_data_discovery() rebuilds the whole dataset
+    _discovery_store()['rebuilt_at'] = None
+
+# Function to connect to Discovery directly and fetch data.
+# After the first full load only rows past the high-water mark are fetched and appended;
+# full_refresh=True, a requested or due full rebuild (see FULL_REFRESH_INTERVAL) or a failed
+# incremental fetch rebuilds the whole dataset.
+# Errors from the full rebuild are raised to the caller, like the SAP loader does.
+def fetch_data_discovery(full_refresh=False):
+    store = _discovery_store()
+    with store['lock']:
+        df = None
+        rebuilt_at = store['rebuilt_at']
+        full_refresh = full_refresh or rebuilt_at is None or time.monotonic() - rebuilt_at > FULL_REFRESH_INTERVAL
+        if not full_refresh and store['watermark'] is not None:
+            try:
+                df, appended = _fetch_incremental(store['df'], store['watermark'])
+                if df is not store['df']:
+                    store['appended'] = (weakref.ref(store['df']), weakref.ref(df), appended)
+            except Exception as e:
+                logger.warning("Incremental Discovery refresh failed, running a full rebuild: %s", e)
+        if df is None:
+            df = _run_query(_read_query())
+            store['rebuilt_at'] = time.monotonic()
+            store['appended'] = None
+        store['df'] = df
+        store['watermark'] = _watermark(df)
+        return df
+
+# Function to fetch distinct-customer counts from one of the KPI_QUERIES.
+# Windows are inclusive (start, end) dates; SAP emails mark a customer as Internal.
+def fetch_kpi_aggregate(grouping, test_window, register_window, internal_emails):
+    one_day = datetime.timedelta(days=1)
+    params = {
+        'test_start': test_window[0],
+        'test_end': test_window[1] + one_day,
+        'register_start': register_window[0],
+        'register_end': register_window[1] + one_day,
+    }
+    query = _read_query(KPI_QUERIES[grouping])
+
+    with _discovery_pool().connection() as conn:
+        with conn.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute("DROP TEMPORARY TABLE IF EXISTS kpi_internal_emails")
+            cursor.execute("CREATE TEMPORARY TABLE kpi_internal_emails (email VARCHAR(255) PRIMARY KEY)")
+            if internal_emails:
+                cursor.executemany("INSERT IGNORE INTO kpi_internal_emails (email) VALUES (%s)", internal_emails)
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+            cursor.execute("DROP TEMPORARY TABLE kpi_internal_emails")
+    return pd.DataFrame(rows)
+
+def _read_sap_mirror():
+    if not (os.path.exists(SAP_MIRROR_FILE) and os.path.exists(SAP_MIRROR_META)):
+        return None, None
+    with open(SAP_MIRROR_META, 'r') as meta_file:
+        meta = json.load(meta_file)
+    return pd.read_parquet(SAP_MIRROR_FILE), meta.get('modified_time')
+
+def _write_sap_mirror(df, modified_time):
+    # Write to temporary files first so a crash never leaves a half-written mirror behind
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    df.to_parquet(SAP_MIRROR_FILE + '.tmp', index=False)
+    os.replace(SAP_MIRROR_FILE + '.tmp', SAP_MIRROR_FILE)
+    with open(SAP_MIRROR_META + '.tmp', 'w') as meta_file:
+        json.dump({'modified_time': modified_time, 'mirrored_at': datetime.datetime.now().isoformat()}, meta_file)
+    os.replace(SAP_MIRROR_META + '.tmp', SAP_MIRROR_META)
+
+def _sheet_modified_time(spreadsheet):
+    # A Drive metadata lookup, much cheaper than downloading the sheet
+    if hasattr(spreadsheet, 'get_lastUpdateTime'):
+        return spreadsheet.get_lastUpdateTime()
+    return spreadsheet.lastUpdateTime
+
+# Function to fetch data from SAP with selected columns.
+# The sheet is only downloaded when its modified time differs from the local mirror;
+# if Google is unreachable the last good mirror is served instead.
 def fetch_data_sap(selected_columns):
-    secret_info = st.secrets["json_sap"]
-    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-    creds = ServiceAccountCredentials.from_json_keyfile_dict(secret_info, scope)
-    client = gspread.authorize(creds)
-    spreadsheet = client.open('0. Active Employee - Monthly Updated')
-    sheet = spreadsheet.sheet1
-    data = sheet.get_all_records()
-    df = pd.DataFrame(data)
+    df, mirrored_time = _read_sap_mirror()
+    try:
+        secret_info = st.secrets["json_sap"]
+        scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+        creds = ServiceAccountCredentials.from_json_keyfile_dict(secret_info, scope)
+        client = gspread.authorize(creds)
+        spreadsheet = client.open(SAP_SPREADSHEET)
+        modified_time = _sheet_modified_time(spreadsheet)
+        if df is None or modified_time != mirrored_time:
+            sheet = spreadsheet.sheet1
+            # Keep every cell as text so the download and the mirror have the same types
+            data = sheet.get_all_records(numericise_ignore=['all'])
+            df = pd.DataFrame(data)
+            try:
+                _write_sap_mirror(df, modified_time)
+            except OSError as e:
+                logger.warning("Could not write the SAP mirror: %s", e)
+    except Exception as e:
+        if df is None:
+            raise
+        logger.warning("Google Sheets is unavailable, serving the SAP mirror from %s: %s", mirrored_time, e)
     return df[selected_columns]
-
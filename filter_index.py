@@ -0,0 +1,198 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+# Columns the sidebar filters of the dashboard pages select on
+FILTER_COLUMNS = ('nik', 'gender', 'unit', 'subunit', 'Last Education', 'Company', 'Province', 'generation',
+                  'layer', 'status', 'bundle_name', 'Test Name', 'typology')
+
+# Date columns the pages filter by range
+DATE_COLUMNS = ('Test Date', 'Register Date')
+
+# Value bitmaps kept per index, the least recently used ones are dropped first
+BITMAP_CACHE_SIZE = 256
+
+
+def _factorize(column):
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column.cat.codes.to_numpy(), column.cat.categories
+    return pd.factorize(column)
+
+def extend_codes(codes, uniques, values):
+    # pd.factorize() of the values codes and uniques were factorised from followed by values,
+    # without factorising the held values again: known values keep their codes, new ones are
+    # coded after them in order of appearance and missing values are -1
+    new_codes = pd.Index(uniques).get_indexer(values)
+    unknown = (new_codes < 0) & values.notna().to_numpy()
+    unknown_codes, unknown_values = pd.factorize(values[unknown])
+    new_codes[unknown] = len(uniques) + unknown_codes
+    return np.concatenate([codes, new_codes]), pd.Index(uniques).append(pd.Index(unknown_values))
+
+def _group_rows(codes, size):
+    # Row positions grouped by code, in row order within every code, and the offsets of the
+    # groups; rows without a value (code -1) come first
+    rows = np.argsort(codes, kind='stable').astype(np.int32)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(codes + 1, minlength=size + 1))])
+    return rows, offsets
+
+def _merge_groups(rows, offsets, mapping, codes, start, size):
+    # Grouped rows (see _group_rows) of held rows whose groups are renumbered by mapping (old
+    # code + 1 to new code) merged with the rows from start on with codes, which are appended to
+    # the slice of their code. No held row is sorted again.
+    held_counts = np.zeros(size + 1, dtype=np.int64)
+    held_counts[mapping + 1] = np.diff(offsets)
+    new_counts = np.bincount(codes + 1, minlength=size + 1)
+    merged_offsets = np.concatenate([[0], np.cumsum(held_counts + new_counts)])
+    merged_rows = np.empty(merged_offsets[-1], dtype=np.int32)
+
+    held_groups = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    merged_rows[merged_offsets[mapping[held_groups] + 1] + np.arange(len(rows)) - offsets[held_groups]] = rows
+
+    new_rows, new_offsets = _group_rows(codes, size)
+    new_groups = np.repeat(np.arange(size + 1), new_counts)
+    merged_rows[merged_offsets[new_groups] + held_counts[new_groups] + np.arange(len(new_rows)) - new_offsets[new_groups]] = new_rows + start
+    return merged_rows, merged_offsets
+
+# Row positions of merged_df for every value of the filter columns, built once per data version.
+# Per column the row positions are stored grouped by value, so the rows of one value are a
+# slice. Date columns are kept as row positions sorted by date, so a date range is found by
+# binary search. A filter turns into a packed bitmap (one bit per row), the bitmaps of all
+# active filters are combined with a bitwise AND and only the final selection is gathered.
+# An index of rows that only appends rows to the ones of a previous index extends it: only the
+# new rows are grouped and merged into the held slices and sorted dates.
+class FilterIndex:
+    def __init__(self, df, columns=FILTER_COLUMNS, date_columns=DATE_COLUMNS, previous=None):
+        self.size = len(df)
+        start = previous.size if previous is not None else 0
+        self._codes = {}
+        self._values = {}
+        self._rows = {}
+        self._offsets = {}
+        for column in columns:
+            if column not in df.columns:
+                continue
+            if previous is not None and column in previous._codes:
+                if isinstance(df[column].dtype, pd.CategoricalDtype):
+                    codes, values = _factorize(df[column])
+                else:
+                    codes, values = extend_codes(previous._codes[column], previous._values[column], df[column].iloc[start:])
+                values = pd.Index(values)
+                mapping = np.append(values.get_indexer(previous._values[column]), -1)[np.arange(-1, len(previous._values[column]))]
+                rows, offsets = _merge_groups(previous._rows[column], previous._offsets[column], mapping, codes[start:], start, len(values))
+            else:
+                codes, values = _factorize(df[column])
+                values = pd.Index(values)
+                # Rows without a value (code -1) sort first and are never selected
+                rows, offsets = _group_rows(codes, len(values))
+            self._codes[column] = codes
+            self._values[column] = values
+            self._rows[column] = rows
+            self._offsets[column] = offsets
+        self._date_rows = {}
+        self._dates = {}
+        for column in date_columns:
+            if column not in df.columns:
+                continue
+            dates = df[column].iloc[start:].to_numpy(dtype='datetime64[ns]')
+            # NaT sorts last and is cut off, rows without a date never match a range
+            rows = np.argsort(dates, kind='stable').astype(np.int32)
+            rows = rows[:len(rows) - np.count_nonzero(np.isnat(dates))]
+            if previous is not None and column in previous._dates:
+                # New rows go after the held rows of the same date, as a stable sort would put them
+                at = np.searchsorted(previous._dates[column], dates[rows], side='right')
+                self._date_rows[column] = np.insert(previous._date_rows[column], at, rows + start)
+                self._dates[column] = np.insert(previous._dates[column], at, dates[rows])
+            else:
+                self._date_rows[column] = rows + start
+                self._dates[column] = dates[rows]
+        self._options = {}
+        self._bitmaps = OrderedDict()
+        self._lock = threading.Lock()
+
+    def rows(self, column, value):
+        code = self._values[column].get_indexer([value])[0]
+        if code < 0:
+            return np.empty(0, dtype=np.int32)
+        offsets = self._offsets[column]
+        return self._rows[column][offsets[code + 1]:offsets[code + 2]]
+
+    def bitmap(self, column, value):
+        key = (column, value)
+        with self._lock:
+            if key in self._bitmaps:
+                self._bitmaps.move_to_end(key)
+                return self._bitmaps[key]
+        mask = np.zeros(self.size, dtype=bool)
+        mask[self.rows(column, value)] = True
+        bits = np.packbits(mask)
+        with self._lock:
+            self._bitmaps[key] = bits
+            while len(self._bitmaps) > BITMAP_CACHE_SIZE:
+                self._bitmaps.popitem(last=False)
+        return bits
+
+    def date_rows(self, column, start=None, end=None):
+        # Rows with start <= date <= end, both bounds inclusive and optional, in date order
+        dates = self._dates[column]
+        lo = 0 if start is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(start), 'ns'), side='left')
+        hi = len(dates) if end is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(end), 'ns'), side='right')
+        return self._date_rows[column][lo:hi]
+
+    def date_bitmap(self, column, start=None, end=None):
+        mask = np.zeros(self.size, dtype=bool)
+        mask[self.date_rows(column, start, end)] = True
+        return np.packbits(mask)
+
+    def match(self, column, values):
+        # Rows whose column is any of values
+        return np.bitwise_or.reduce([self.bitmap(column, value) for value in values])
+
+    def select(self, filters=None, dates=None, masks=()):
+        # filters maps a column to the accepted values, columns without values are not filtered.
+        # dates maps a date column to an inclusive (start, end) range.
+        # masks are extra boolean row masks, e.g. from the name search.
+        # Returns the sorted row positions that pass every filter, ready for df.take().
+        bits = None
+        selections = [self.match(column, values) for column, values in (filters or {}).items() if len(values)]
+        selections += [self.date_bitmap(column, *bounds) for column, bounds in (dates or {}).items()]
+        selections += [np.packbits(np.asarray(mask, dtype=bool)) for mask in masks]
+        for selection in selections:
+            bits = selection if bits is None else bits & selection
+        if bits is None:
+            return np.arange(self.size)
+        return np.flatnonzero(np.unpackbits(bits, count=self.size))
+
+    def options(self, column):
+        # Distinct values of column in order of first appearance, like df[column].dropna().unique().
+        # The first row of every value is the head of its slice, so no rows are scanned.
+        if column not in self._options:
+            offsets = self._offsets[column]
+            present = np.flatnonzero(np.diff(offsets[1:]))
+            first_rows = self._rows[column][offsets[1:-1][present]]
+            self._options[column] = self._values[column][present[np.argsort(first_rows)]].tolist()
+        return self._options[column]
+
+# Distinct value paths through a hierarchy of columns (e.g. bundle_name -> Test Name -> typology)
+# among the rows passing filters, kept in order of their first row. Cascading option lists are
+# answered from these paths, whose number doesn't grow with the number of rows.
+class OptionTree:
+    def __init__(self, df, columns, positions):
+        self.columns = list(columns)
+        self._paths = df[self.columns].take(positions).drop_duplicates().reset_index(drop=True)
+
+    def options(self, column, selected):
+        # selected maps columns above column to their accepted values, columns without values
+        # accept everything. Same order as dropna().unique() on the filtered rows.
+        paths = self._paths
+        for name, values in selected.items():
+            if len(values):
+                paths = paths[paths[name].isin(values)]
+        return paths[column].dropna().unique().tolist()
+
+def get_filter_index(dataset):
+    return dataset.derived('filter_index', lambda dataset: FilterIndex(dataset.merged))
+
+def get_option_tree(dataset, columns, filters):
+    key = ('option_tree', tuple(columns), tuple((column, tuple(values)) for column, values in filters.items()))
+    return dataset.derived(key, lambda dataset: OptionTree(dataset.merged, columns, get_filter_index(dataset).select(filters)))
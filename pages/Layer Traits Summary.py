@@ -2,7 +2,12 @@
 import pandas as pd
 import streamlit as st
 import altair as alt
-from data_processing import finalize_data
+from data_processing import get_dataset
+from filter_index import get_filter_index
+from distinct_cube import get_distinct_cube
+from traits_summary import LAYER_GROUP_NAMES, SUMMARY_BUNDLES, get_traits_summary, layers_of
+from bundle_aggregates import get_rank_table
+from attempts import get_latest_attempts
 
 # Setting page title and favicon
 st.set_page_config(page_title='Internal KG')
@@ -26,159 +31,50 @@ st.markdown("""
     - **Non Struktural** adalah Group 1, Group 2, Group 3, Group 4 dan Group 5 
 """)
 
-# Caching function for loading and processing data
-@st.cache_data
-def load_and_process_data():
-    # Load and process data
-    df_discovery, df_sap, merged_df = finalize_data()
-    merged_df['nik'] = merged_df['nik'].astype(str).str.replace(',', '', regex=False)
-    merged_df['Customer ID'] = merged_df['Customer ID'].astype(str).str.replace(',', '', regex=False)
-    merged_df["Test Date"] = pd.to_datetime(merged_df["Test Date"])
-    merged_df["Register Date"] = pd.to_datetime(merged_df["Register Date"])
-    return merged_df
-
-# Load data with caching
-merged_df = load_and_process_data()
-
-# Filter data for internal users
-internal_df = merged_df[merged_df['status'] == 'Internal']
-
-# Mapping for grouping layers
-layer_mapping = {
-    'Group 5 Str Layer 1': 'Layer 1',
-    'Group 4 Str Layer 2': 'Layer 2',
-    'Group 3 Str Layer 3B': 'Layer 3',
-    'Group 3 Str Layer 3A': 'Layer 3',
-    'Group 2 Str Layer 4': 'Layer 4',
-    'Group 1 Str Layer 5': 'Layer 5',
-    'Group 1': 'Non Struktural',
-    'Group 2': 'Non Struktural',
-    'Group 3': 'Non Struktural',
-    'Group 4': 'Non Struktural',
-    'Group 5': 'Non Struktural'
-
-}
-
-# Apply the mapping to create a new column for grouped layers
-internal_df['layer_group'] = internal_df['layer'].map(layer_mapping)
+# Load the cleaned and typed data from data_processing
+dataset = get_dataset()
+merged_df = dataset.merged
 
 # Sidebar filters with multiselect
 st.sidebar.header("Filter Options")
 selected_layers = st.sidebar.multiselect(
     "Select Layers",
-    options=['Layer 1', 'Layer 2', 'Layer 3', 'Layer 4', 'Layer 5', 'Non Struktural'],
+    options=LAYER_GROUP_NAMES,
     default=[]
 )
 
-# Filter based on selected layers
-df_filtered = internal_df[internal_df['layer_group'].isin(selected_layers)] if selected_layers else internal_df
+# Traits summaries of internal users, built from facts materialised once per data version
+traits_summary = get_traits_summary(dataset)
 
 # Add unit filter to the sidebar
 selected_units = st.sidebar.multiselect(
     "Select Unit",
-    options=df_filtered['unit'].unique(),
+    options=traits_summary.units(selected_layers),
     default=[]
 )
 
-# Apply unit filter if units are selected
-if selected_units:
-    df_filtered = df_filtered[df_filtered['unit'].isin(selected_units)]
+# Filter internal users based on selected layers and units, looked up on the filter index
+filters = {'status': ['Internal'], 'layer': layers_of(selected_layers), 'unit': selected_units}
+df_filtered = merged_df.take(get_filter_index(dataset).select(filters))
 
 # Active learners by bundle
 bundle_names = ['GI', 'LEAN', 'ELITE', 'Genuine', 'Astaka']
 
-# Create filtered dataframe for active learners
-if 'bundle_name' in df_filtered.columns:
-    df_active_learners = df_filtered.groupby(['Customer ID', 'Test Date', 'bundle_name']).size().reset_index(name='test_count')
+# Count active learners per bundle, from the distinct-count cube
+bundle_users = get_distinct_cube(dataset).count(filters, by=['bundle_name']).set_index('bundle_name')['Customer ID']
+bundle_counts = {bundle: int(bundle_users.get(bundle, 0)) for bundle in bundle_names}
 
-    # Count active learners per bundle
-    bundle_counts = {bundle: df_active_learners[df_active_learners['bundle_name'] == bundle]['Customer ID'].nunique() for bundle in bundle_names}
+# Display active learners counts
+st.markdown("<h3>ACTIVE LEARNERS</h3>", unsafe_allow_html=True)
+col1, col2, col3, col4, col5 = st.columns(5)
 
-    # Display active learners counts
-    st.markdown("<h3>ACTIVE LEARNERS</h3>", unsafe_allow_html=True)
-    col1, col2, col3, col4, col5 = st.columns(5)
+for i, bundle in enumerate(bundle_names):
+    with eval(f'col{i + 1}'):
+        st.markdown(f"<p style='font-size: 20px; text-align: center;'><strong>{bundle}: <span style='color: red;'>{bundle_counts[bundle]:,}</span></strong></p>", unsafe_allow_html=True)
 
-    for i, bundle in enumerate(bundle_names):
-        with eval(f'col{i + 1}'):
-            st.markdown(f"<p style='font-size: 20px; text-align: center;'><strong>{bundle}: <span style='color: red;'>{bundle_counts[bundle]:,}</span></strong></p>", unsafe_allow_html=True)
-                
-
-# 1. Get the latest test results for each email and Test Name
-latest_test_results = df_filtered.loc[df_filtered.groupby(['email', 'Test Name'])['Test Date'].idxmax()]
-
-# 2. Count participants based on bundle_name
-participant_counts = df_filtered.groupby('bundle_name')['email'].nunique().reset_index()
-participant_counts.columns = ['bundle_name', 'jumlah_partisipan']
-
-# 3. Count users based on typology from the latest results
-typology_user_counts = latest_test_results.groupby('typology')['email'].nunique().reset_index()
-typology_user_counts.columns = ['typology', 'jumlah']
-
-# 4. Get unique Test Name for each bundle_name
-test_names = df_filtered[['bundle_name', 'Test Name']].drop_duplicates()
-
-# 5. Get all unique typology results for each Test Name
-typology_results = latest_test_results.groupby(['Test Name', 'typology'])['email'].nunique().reset_index()
-typology_results.columns = ['Test Name', 'typology', 'jumlah']
-
-# 6. Calculate percentages for each typology per Test Name
-total_users_per_test = typology_results.groupby('Test Name')['jumlah'].transform('sum')
-typology_results['persentase'] = (typology_results['jumlah'] / total_users_per_test * 100).round(2)
-
-# 7. Combine results into one DataFrame
-result_df = pd.merge(participant_counts, test_names, on='bundle_name', how='left')
-result_df = pd.merge(result_df, typology_results, on='Test Name', how='left')
-
-# 8. Add rows for Overall ELITE based on filtered results
-final_results_elite = latest_test_results[latest_test_results['bundle_name'] == 'ELITE'].groupby('final_result')['email'].nunique().reset_index()
-overall_elite_rows = [{
-    'bundle_name': 'ELITE',
-    'jumlah_partisipan': participant_counts.loc[participant_counts['bundle_name'] == 'ELITE', 'jumlah_partisipan'].values[0],
-    'Test Name': 'Overall ELITE',
-    'typology': row['final_result'],
-    'jumlah': row['email'],
-    'persentase': (row['email'] / participant_counts.loc[participant_counts['bundle_name'] == 'ELITE', 'jumlah_partisipan'].values[0] * 100).round(2)
-} for _, row in final_results_elite.iterrows()]
-
-overall_elite_df = pd.DataFrame(overall_elite_rows)
-
-# 9. Add rows for Overall LEAN based on filtered results
-final_results_lean = latest_test_results[latest_test_results['bundle_name'] == 'LEAN'].groupby('final_result')['email'].nunique().reset_index()
-overall_lean_rows = [{
-    'bundle_name': 'LEAN',
-    'jumlah_partisipan': participant_counts.loc[participant_counts['bundle_name'] == 'LEAN', 'jumlah_partisipan'].values[0],
-    'Test Name': 'Overall LEAN',
-    'typology': row['final_result'],
-    'jumlah': row['email'],
-    'persentase': (row['email'] / participant_counts.loc[participant_counts['bundle_name'] == 'LEAN', 'jumlah_partisipan'].values[0] * 100).round(2)
-} for _, row in final_results_lean.iterrows()]
-
-overall_lean_df = pd.DataFrame(overall_lean_rows)
-
-# 10. Combine result_df with overall_elite_df and overall_lean_df
-result_df = pd.concat([result_df, overall_elite_df, overall_lean_df], ignore_index=True)
-
-# 11. Filter for desired bundles: GI, ELITE, LEAN
-filtered_bundles = ['GI', 'ELITE', 'LEAN']
-result_df = result_df[result_df['bundle_name'].isin(filtered_bundles)]
-
-# 12. Set categorical order and sort
-result_df['bundle_name'] = pd.Categorical(result_df['bundle_name'], categories=filtered_bundles, ordered=True)
-result_df = result_df.sort_values(['bundle_name', 'Test Name']).reset_index(drop=True)
-
-# 13. Combine number of users with result_df without additional calculations
-combined_result_df = pd.merge(result_df, typology_user_counts[['typology']], on='typology', how='left')
-
-# 14. Create a custom sort order for 'Test Name'
-def custom_sort_order(test_name):
-    if test_name in ["Mindset", "Overall ELITE", "Overall LEAN"]:
-        return 0
-    return 1
-
-combined_result_df['sort_order'] = combined_result_df['Test Name'].apply(custom_sort_order)
-
-# Sort by bundle_name and custom sort order
-combined_result_df = combined_result_df.sort_values(['bundle_name', 'sort_order', 'Test Name']).reset_index(drop=True)
+# Summary of every bundle for the selected layers and units, the bundle filter picks from it
+combined_result_df = traits_summary.summary(selected_layers, selected_units)
+filtered_bundles = SUMMARY_BUNDLES
 
 # 15. Bundle filter
 st.sidebar.header("Bundle Name Filter")
@@ -208,7 +104,7 @@ st.subheader(f"{selected_bundle} Traits Summary for {selected_layers_title} ({se
 st.dataframe(combined_result_df.drop(columns=['sort_order']))
 
 # Menghitung total pengguna untuk setiap Test Name
-total_users_per_test = combined_result_df.groupby('Test Name')['jumlah'].transform('sum')
+total_users_per_test = combined_result_df.groupby('Test Name', observed=True)['jumlah'].transform('sum')
 
 # Menghitung persentase untuk setiap typology pada masing-masing Test Name
 combined_result_df['persentase'] = (combined_result_df['jumlah'] / total_users_per_test * 100).round(2)
@@ -240,29 +136,17 @@ stacked_bar_chart = alt.Chart(combined_result_df).mark_bar().encode(
 # Menampilkan stacked bar chart di Streamlit
 st.altair_chart(stacked_bar_chart, use_container_width=True)
 
-# Filter for 'Genuine' bundle
-genuine_filtered = df_filtered[df_filtered['bundle_name'] == 'Genuine']
-
-# Get the highest scores
-highest_scores = genuine_filtered.loc[genuine_filtered.groupby(['email', 'Test Date', 'Test Name'])['total_score'].idxmax()]
-
-# Select relevant columns for the genuine active learners data
-genuine_active_learners_data = highest_scores[['name', 'email', 'Customer ID', 'bundle_name', 'Test Date', 'Test Name', 'total_score', 'final_result']]
-
-# Add a rank column from 1 to 9 based on total_score for each Customer ID and Test Date
-genuine_active_learners_data['rank'] = genuine_active_learners_data.groupby(['Customer ID', 'Test Date'])['total_score'].rank(ascending=False, method='first').astype(int)
-
-# Filter ranks from 1 to 9
-genuine_active_learners_data = genuine_active_learners_data[genuine_active_learners_data['rank'] <= 9]
+# Ranked highest scores of the 'Genuine' bundle (ranks 1 to 9 per Customer ID and Test Date), from the rank table
+genuine_ranked = get_rank_table(dataset).ranked('Genuine', df_filtered.index)
 
 # Add a select box for filtering by rank
 selected_rank = st.selectbox("Select Rank", options=range(1, 10), index=0)
 
 # Filter the data based on the selected rank
-filtered_data_by_rank = genuine_active_learners_data[genuine_active_learners_data['rank'] == selected_rank]
+filtered_data_by_rank = df_filtered.loc[genuine_ranked.index[genuine_ranked['rank'] == selected_rank]]
 
-# Get the latest Test Date results for each email
-latest_results = filtered_data_by_rank.loc[filtered_data_by_rank.groupby('email')['Test Date'].idxmax()]
+# Get the latest Test Date results for each email, from the latest-attempt selection
+latest_results = df_filtered.loc[get_latest_attempts(dataset, ['email']).select(filtered_data_by_rank.index)]
 
 # Calculate jumlah_partisipan (total unique email for the bundle)
 total_participants = latest_results['email'].nunique()
@@ -272,7 +156,7 @@ st.subheader(f"Genuine TOP {selected_rank} Traits Summary for {selected_layers_t
 # Prepare the data for display
 summary_data = (
     latest_results
-    .groupby(['bundle_name', 'Test Name'])  # Group by bundle_name and Test Name
+    .groupby(['bundle_name', 'Test Name'], observed=True)  # Group by bundle_name and Test Name
     .agg(
         jumlah_partisipan=('email', 'nunique'),  # Count of unique email based only on Test Name
         jumlah=('email', 'count')  # Count of total entries based on email per Test Name
@@ -302,29 +186,17 @@ bar_chart = alt.Chart(summary_data).mark_bar().encode(
 # Display the bar chart
 st.altair_chart(bar_chart, use_container_width=True)
 
-# Filter for 'Astaka' bundle
-astaka_filtered = df_filtered[df_filtered['bundle_name'] == 'Astaka']
-
-# Get the highest scores
-highest_scores = astaka_filtered.loc[astaka_filtered.groupby(['email', 'Test Date', 'Test Name'])['total_score'].idxmax()]
-
-# Select relevant columns for the genuine active learners data
-astaka_active_learners_data = highest_scores[['name', 'email', 'Customer ID', 'bundle_name', 'Test Date', 'Test Name', 'total_score', 'final_result']]
-
-# Add a rank column from 1 to 6 based on total_score for each Customer ID and Test Date
-astaka_active_learners_data['rank'] = astaka_active_learners_data.groupby(['Customer ID', 'Test Date'])['total_score'].rank(ascending=False, method='first').astype(int)
-
-# Filter ranks from 1 to 6
-astaka_active_learners_data = astaka_active_learners_data[astaka_active_learners_data['rank'] <= 6]
+# Ranked highest scores of the 'Astaka' bundle (ranks 1 to 6 per Customer ID and Test Date), from the rank table
+astaka_ranked = get_rank_table(dataset).ranked('Astaka', df_filtered.index)
 
 # Add a select box for filtering by rank
 selected_rank = st.selectbox("Select Rank", options=range(1, 7), index=0)
 
 # Filter the data based on the selected rank
-filtered_data_by_rank = astaka_active_learners_data[astaka_active_learners_data['rank'] == selected_rank]
+filtered_data_by_rank = df_filtered.loc[astaka_ranked.index[astaka_ranked['rank'] == selected_rank]]
 
-# Get the latest Test Date results for each email
-latest_results = filtered_data_by_rank.loc[filtered_data_by_rank.groupby('email')['Test Date'].idxmax()]
+# Get the latest Test Date results for each email, from the latest-attempt selection
+latest_results = df_filtered.loc[get_latest_attempts(dataset, ['email']).select(filtered_data_by_rank.index)]
 
 # Calculate jumlah_partisipan (total unique email for the bundle)
 total_participants = latest_results['email'].nunique()
@@ -332,7 +204,7 @@ total_participants = latest_results['email'].nunique()
 # Prepare the data for display
 summary_data = (
     latest_results
-    .groupby(['bundle_name', 'Test Name'])  # Group by bundle_name and Test Name
+    .groupby(['bundle_name', 'Test Name'], observed=True)  # Group by bundle_name and Test Name
     .agg(
         jumlah_partisipan=('email', 'nunique'),  # Count of unique email based only on Test Name
         jumlah=('email', 'count')  # Count of total entries based on email per Test Name
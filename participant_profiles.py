@@ -0,0 +1,133 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from filter_index import get_filter_index
+
+# Profile column of every displayed test per bundle. The typology of the first attempt with one
+# is shown; a participant is only listed with a GI typology.
+PROFILE_TRAITS = {
+    'GI': {
+        'Mindset': 'mindset',
+        'Creativity Style': 'creativity_style',
+        'Humility': 'humility',
+        'Grit': 'grit',
+        'Curiosity': 'curiosity',
+        'Meaning Making': 'meaning_making',
+        'Purpose in Life': 'purpose_in_life',
+    },
+    'LEAN': {
+        'Intellectual Curiosity': 'Intellectual Curiosity',
+        'Unconventional Thinking': 'Unconventional Thinking',
+        'Cognitive Flexibility': 'Cognitive Flexibility',
+        'Open-Mindedness': 'Open-Mindedness',
+        'Social Astuteness': 'Social Astuteness',
+        'Social Flexibility': 'Social Flexibility',
+        'Personal Learner': 'Personal Learner',
+        'Self-Reflection': 'Self-Reflection',
+    },
+    'ELITE': {
+        'Self-Awareness': 'Self-Awareness',
+        'Self-Regulation': 'Self - Regulation',
+        'Motivation': 'Motivation',
+        'Empathy': 'Empathy',
+        'Social skills': 'Social skills',
+    },
+}
+
+# Column of the final results per bundle
+PROFILE_RESULTS = {'GI': 'persona', 'LEAN': 'Overall LEAN', 'ELITE': 'Overall ELITE'}
+
+PROFILE_COLUMNS = ['name', 'email', 'phone', 'persona',
+                   'mindset', 'creativity_style', 'humility', 'grit', 'curiosity', 'meaning_making', 'purpose_in_life',
+                   'Overall LEAN', 'Intellectual Curiosity', 'Unconventional Thinking', 'Cognitive Flexibility',
+                   'Open-Mindedness', 'Social Astuteness', 'Social Flexibility', 'Personal Learner',
+                   'Self-Reflection', 'Self - Regulation', 'Overall ELITE', 'Self-Awareness', 'Motivation', 'Empathy', 'Social skills']
+
+# Profile tables kept per Test Date range, the least recently used ones are dropped first
+PROFILE_CACHE_SIZE = 8
+
+
+def _sort_codes(column):
+    # Integer codes ordered like groupby orders the values, -1 for missing values
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column.cat.codes.to_numpy().astype(np.int64), column.cat.categories
+    codes, values = pd.factorize(column, sort=True)
+    return codes.astype(np.int64), pd.Index(values)
+
+# One row per participant (an email and phone pair) with the typology of every displayed test
+# and the final results of GI, LEAN and ELITE, built in one pass over the rows of a Test Date
+# range: one dedupe picks the first typology of every participant and test for all bundles at
+# once, and only the final results of participants with several fan out to several rows.
+# Participants are numbered in (email, phone) order, so an email or phone search slices a
+# profile table by participant instead of rebuilding it.
+class ParticipantProfiles:
+    def __init__(self, dataset):
+        merged = dataset.merged
+        self._df = merged[['bundle_name', 'Test Name', 'typology', 'name', 'final_result']]
+        self._index = get_filter_index(dataset)
+        email_codes, emails = _sort_codes(merged['email'])
+        phone_codes, phones = _sort_codes(merged['phone'])
+        valid = (email_codes >= 0) & (phone_codes >= 0)
+        keys, participants = np.unique(email_codes[valid] * len(phones) + phone_codes[valid], return_inverse=True)
+        self.participant = np.full(len(merged), -1, dtype=np.int64)
+        self.participant[valid] = participants
+        self.emails = emails.take(keys // len(phones)) if len(keys) else emails[:0]
+        self.phones = phones.take(keys % len(phones)) if len(keys) else phones[:0]
+        self._tests = {(bundle, test): column for bundle, tests in PROFILE_TRAITS.items() for test, column in tests.items()}
+        self._profiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _build(self, dates):
+        rows = self._index.select(dates=dates)
+        rows = rows[self.participant[rows] >= 0]
+        df = self._df.take(rows)
+        df = df.assign(participant=self.participant[rows])[df['bundle_name'].isin(list(PROFILE_TRAITS)).to_numpy()]
+
+        # First typology of every participant and test
+        traits = df[df['typology'].notna()].drop_duplicates(['participant', 'bundle_name', 'Test Name'])
+        tested = {bundle: traits.loc[traits['bundle_name'] == bundle, 'participant'].unique() for bundle in PROFILE_TRAITS}
+        columns = pd.Series(list(zip(traits['bundle_name'], traits['Test Name'])), index=traits.index).map(self._tests)
+        traits = traits.assign(column=columns).dropna(subset=['column'])
+        wide = traits.pivot(index='participant', columns='column', values='typology')
+
+        # Every final result of a participant is one row, as many rows as combinations
+        profile = pd.DataFrame({'participant': np.sort(tested['GI'])})
+        for bundle, column in PROFILE_RESULTS.items():
+            results = df[(df['bundle_name'] == bundle).to_numpy() & np.isin(df['participant'], tested[bundle])]
+            keys = ['participant', 'name', 'final_result'] if bundle == 'GI' else ['participant', 'final_result']
+            results = results.drop_duplicates(keys)[keys].rename(columns={'final_result': column})
+            profile = profile.merge(results, on='participant', how='left')
+        profile['email'] = self.emails.take(profile['participant']).array
+        profile['phone'] = self.phones.take(profile['participant']).array
+        wide = wide.reindex(index=profile['participant'], columns=list(self._tests.values())).astype(self._df['typology'].dtype)
+        for column in wide.columns:
+            profile[column] = wide[column].array
+        return profile
+
+    def profile(self, dates=None):
+        # Profile table of the rows in dates (see FilterIndex.select), with a participant column
+        key = tuple(sorted((column, tuple(pd.Timestamp(bound) for bound in bounds)) for column, bounds in (dates or {}).items()))
+        with self._lock:
+            if key in self._profiles:
+                self._profiles.move_to_end(key)
+                return self._profiles[key]
+        profile = self._build(dates)
+        with self._lock:
+            self._profiles[key] = profile
+            while len(self._profiles) > PROFILE_CACHE_SIZE:
+                self._profiles.popitem(last=False)
+        return profile
+
+    def select(self, dates=None, masks=()):
+        # Profile rows of the participants with a row in every boolean row mask, e.g. an email
+        # search; a search always matches all rows of a participant or none
+        profile = self.profile(dates)
+        if not masks:
+            return profile
+        matched = np.logical_and.reduce([np.asarray(mask, dtype=bool) for mask in masks])
+        participants = np.unique(self.participant[matched & (self.participant >= 0)])
+        return profile[np.isin(profile['participant'], participants)].reset_index(drop=True)
+
+def get_participant_profiles(dataset):
+    return dataset.derived('participant_profiles', ParticipantProfiles)
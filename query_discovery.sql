@@ -19,7 +19,9 @@ SELECT
     i.name AS 'Institution', 
     c.company AS 'Company',
     c.last_education AS 'Last Education',
-    c.id AS 'Customer ID'  -- Menambahkan Customer ID
+    c.id AS 'Customer ID',  -- Menambahkan Customer ID
+    ur.id AS 'Result ID',
+    ubr.id AS 'Bundle Result ID'
 FROM user_results ur
 LEFT JOIN tests t ON
     ur.test_id = t.id
@@ -0,0 +1,26 @@
+-- Distinct customers per bundle and status in the date window
+-- kpi_internal_emails is a temporary table holding the SAP employee emails
+SELECT  
+    CASE 
+        WHEN ubr.bundle_id = 1 THEN 'GI'
+        WHEN ubr.bundle_id = 2 THEN 'LEAN'
+        WHEN ubr.bundle_id = 3 THEN 'ELITE'
+        WHEN ubr.bundle_id = 4 THEN 'Genuine'
+        WHEN ubr.bundle_id = 5 THEN 'Astaka'
+    END AS bundle_name,
+    CASE WHEN ie.email IS NULL THEN 'External' ELSE 'Internal' END AS status,
+    COUNT(DISTINCT c.id) AS users
+FROM user_results ur
+JOIN users u ON 
+    ur.user_id = u.id
+JOIN user_bundle_result_user_result ubrur ON 
+    ur.id = ubrur.user_result_id
+JOIN user_bundle_results ubr ON 
+    ubrur.user_bundle_result_id = ubr.id
+LEFT JOIN customers c ON
+    u.id = c.user_id
+LEFT JOIN kpi_internal_emails ie ON
+    ie.email = LOWER(TRIM(u.email))
+WHERE ubr.created_at >= %(test_start)s AND ubr.created_at < %(test_end)s
+    AND u.created_at >= %(register_start)s AND u.created_at < %(register_end)s
+GROUP BY bundle_name, status;
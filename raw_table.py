@@ -0,0 +1,54 @@
+import numpy as np
+import streamlit as st
+
+# Rows per page the raw data tables offer, the first is the default
+PAGE_SIZES = [50, 100, 250, 500]
+
+
+def _sort_order(dataset, column, ascending):
+    # Row positions of the dataset sorted by column, ties in row order and missing values last,
+    # built once per data version, column and direction
+    def build(dataset):
+        order = dataset.merged[column].sort_values(ascending=ascending, kind='stable', na_position='last').index
+        return order.to_numpy().astype(np.int32)
+    return dataset.derived(('sort_order', column, ascending), build)
+
+def page_rows(dataset, positions, page, page_size, sort_by=None, ascending=True):
+    # Row positions of one page of the selected rows (sorted positions of the dataset), sorted
+    # by sort_by or in row order. Sorting reuses the sort order of the whole dataset, so only
+    # the selection is filtered out of it.
+    positions = np.asarray(positions)
+    start = page * page_size
+    if sort_by is None:
+        return positions[start:start + page_size]
+    order = _sort_order(dataset, sort_by, ascending)
+    selected = np.zeros(len(dataset.merged), dtype=bool)
+    selected[positions] = True
+    return order[selected[order]][start:start + page_size]
+
+# Raw data viewer for the rows at positions of the dataset. Paging, sorting and the column
+# selection happen here, only the visible page of the chosen columns is sent to the browser.
+def show_raw_table(dataset, positions, key):
+    columns = list(dataset.merged.columns)
+    total = len(positions)
+
+    col1, col2, col3 = st.columns([3, 2, 1])
+    with col1:
+        selected_columns = st.multiselect("Columns", columns, default=columns, key=f'{key}_columns')
+    with col2:
+        sort_by = st.selectbox("Sort by", ["(none)"] + columns, key=f'{key}_sort_by')
+    with col3:
+        ascending = st.selectbox("Order", ["Ascending", "Descending"], key=f'{key}_order') == "Ascending"
+
+    col1, col2 = st.columns([1, 1])
+    with col1:
+        page_size = st.selectbox("Rows per page", PAGE_SIZES, key=f'{key}_page_size')
+    # A new page count resets the page to the first one
+    pages = max((total - 1) // page_size + 1, 1)
+    with col2:
+        page = st.number_input(f"Page (of {pages:,})", min_value=1, max_value=pages, value=1, step=1, key=f'{key}_page')
+
+    rows = page_rows(dataset, positions, page - 1, page_size, None if sort_by == "(none)" else sort_by, ascending)
+    st.dataframe(dataset.merged.take(rows)[selected_columns])
+    first = (page - 1) * page_size
+    st.caption(f"Rows {min(first + 1, total):,}-{first + len(rows):,} of {total:,}")
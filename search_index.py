@@ -0,0 +1,123 @@
+import threading
+import numpy as np
+import pandas as pd
+from filter_index import extend_codes
+
+# Distinct values are split into trigrams in blocks of this many values
+TRIGRAM_BLOCK = 10000
+
+
+def _trigram_keys(chars):
+    # Three code points packed into one integer, code points fit in 21 bits
+    return (chars[..., :-2] << 42) | (chars[..., 1:-1] << 21) | chars[..., 2:]
+
+def _trigram_postings(values, first_code=0):
+    # Sorted distinct trigram keys and, per key, the codes of the values containing it.
+    # Values are coded from first_code on, in order.
+    keys, codes = [], []
+    for start in range(0, len(values), TRIGRAM_BLOCK):
+        block = np.array(values[start:start + TRIGRAM_BLOCK], dtype=str)
+        width = block.dtype.itemsize // 4
+        if width < 3:
+            continue
+        chars = block.view(np.uint32).reshape(len(block), width).astype(np.int64)
+        grams = _trigram_keys(chars)
+        valid = np.arange(width - 2) < (np.char.str_len(block) - 2)[:, None]
+        keys.append(grams[valid])
+        codes.append(np.broadcast_to(first_code + np.arange(start, start + len(block))[:, None], grams.shape)[valid])
+    if not keys:
+        return np.empty(0, dtype=np.int64), np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.int32)
+    keys, codes = np.concatenate(keys), np.concatenate(codes)
+    # Codes are already ascending, a stable sort keeps them ascending within each key
+    order = np.argsort(keys, kind='stable')
+    keys, codes = keys[order], codes[order]
+    # A value repeating a trigram is listed once
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = (keys[1:] != keys[:-1]) | (codes[1:] != codes[:-1])
+    keys, codes = keys[first], codes[first].astype(np.int32)
+    gram_keys, starts = np.unique(keys, return_index=True)
+    return gram_keys, np.append(starts, len(keys)), codes
+
+def _merge_postings(held, new):
+    # Postings of the held values and of new values coded after them, the postings of every
+    # trigram stay ascending without sorting the held ones again
+    (held_keys, held_offsets, held_codes), (new_keys, new_offsets, new_codes) = held, new
+    keys = np.repeat(held_keys, np.diff(held_offsets))
+    at = np.searchsorted(keys, np.repeat(new_keys, np.diff(new_offsets)), side='right')
+    keys = np.insert(keys, at, np.repeat(new_keys, np.diff(new_offsets)))
+    codes = np.insert(held_codes, at, new_codes)
+    starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]])[:len(keys)])
+    return keys[starts], np.append(starts, len(keys)), codes
+
+# Substring search over one column. Every distinct value is lower-cased once and split into
+# trigrams; a query is answered from the intersection of the posting lists of its trigrams
+# and only those candidates are checked, instead of scanning every row. Extending the index
+# of the first rows of column (previous) only splits the values that are new.
+class _ColumnIndex:
+    def __init__(self, column, previous=None):
+        if previous is None:
+            self.codes, self.uniques = pd.factorize(column)
+            self.values = pd.Series(self.uniques, dtype=object).str.lower()
+            self.gram_keys, self.gram_offsets, self.gram_codes = _trigram_postings(self.values.to_numpy())
+            return
+        held = len(previous.uniques)
+        self.codes, self.uniques = extend_codes(previous.codes, previous.uniques, column.iloc[len(previous.codes):])
+        values = pd.Series(self.uniques[held:], dtype=object).str.lower()
+        self.values = pd.concat([previous.values, values], ignore_index=True)
+        self.gram_keys, self.gram_offsets, self.gram_codes = _merge_postings(
+            (previous.gram_keys, previous.gram_offsets, previous.gram_codes), _trigram_postings(values.to_numpy(), held))
+
+    def _posting(self, key):
+        position = np.searchsorted(self.gram_keys, key)
+        if position == len(self.gram_keys) or self.gram_keys[position] != key:
+            return np.empty(0, dtype=np.int32)
+        return self.gram_codes[self.gram_offsets[position]:self.gram_offsets[position + 1]]
+
+    def search(self, query):
+        query = query.lower()
+        if len(query) < 3:
+            # Too short for trigrams, scan the distinct values instead of the rows
+            return np.flatnonzero(self.values.str.contains(query, regex=False).to_numpy())
+        keys = np.unique(_trigram_keys(np.array([ord(char) for char in query], dtype=np.int64)))
+        candidates = None
+        for codes in sorted((self._posting(key) for key in keys), key=len):
+            candidates = codes if candidates is None else np.intersect1d(candidates, codes, assume_unique=True)
+            if not len(candidates):
+                break
+        return candidates[[query in value for value in self.values.iloc[candidates]]]
+
+    def mask(self, codes):
+        # Boolean row mask for a set of value codes, rows without a value never match
+        hit = np.zeros(len(self.values) + 1, dtype=bool)
+        hit[np.asarray(codes) + 1] = True
+        return hit[self.codes + 1]
+
+# Case-insensitive participant search over name, email and phone, built once per data version.
+# Columns are indexed lazily on their first search. An index of rows that only appends rows to
+# the ones of a previous index extends the columns that one has indexed.
+class SearchIndex:
+    def __init__(self, df, previous=None):
+        self._df = df
+        self._indexes = {}
+        self._lock = threading.Lock()
+        if previous is not None:
+            with previous._lock:
+                indexes = dict(previous._indexes)
+            for column, index in indexes.items():
+                self._indexes[column] = _ColumnIndex(df[column], index)
+
+    def _index(self, column):
+        with self._lock:
+            if column not in self._indexes:
+                self._indexes[column] = _ColumnIndex(self._df[column])
+            return self._indexes[column]
+
+    def search(self, column, query):
+        # Boolean row mask of the rows whose column contains query, ignoring case, like
+        # str.contains(query, case=False, regex=False). A complete email or phone number also
+        # matches every longer value containing it, e.g. ann@kg.id finds joann@kg.id.
+        index = self._index(column)
+        return index.mask(index.search(query))
+
+def get_search_index(dataset):
+    return dataset.derived('search_index', lambda dataset: SearchIndex(dataset.merged))
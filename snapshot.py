@@ -0,0 +1,67 @@
+import datetime
+import json
+import logging
+import os
+import shutil
+import time
+import pandas as pd
+from fetch_data import CACHE_DIR
+
+# Bump whenever the layout of the snapshot frames changes, older snapshots are then ignored
+SNAPSHOT_FORMAT = 3
+SNAPSHOT_DIR = os.path.join(CACHE_DIR, 'snapshots')
+LATEST_FILE = os.path.join(SNAPSHOT_DIR, 'LATEST')
+# Number of snapshots kept on disk, the newest ones win
+SNAPSHOTS_KEPT = 2
+
+logger = logging.getLogger(__name__)
+
+
+# Snapshots are stored as zstd-compressed, dictionary-encoded Parquet files, one per frame,
+# in a versioned directory. LATEST points at the newest complete snapshot.
+def save_snapshot(frames):
+    version = f"v{SNAPSHOT_FORMAT}-{datetime.datetime.now().strftime('%Y%m%dT%H%M%S%f')}-{os.getpid()}"
+    path = os.path.join(SNAPSHOT_DIR, version)
+    os.makedirs(path + '.tmp', exist_ok=True)
+    for name, df in frames.items():
+        df.to_parquet(os.path.join(path + '.tmp', f'{name}.parquet'), index=False, compression='zstd', use_dictionary=True)
+    manifest = {
+        'format': SNAPSHOT_FORMAT,
+        'version': version,
+        'created_at': time.time(),
+        'rows': {name: len(df) for name, df in frames.items()},
+    }
+    with open(os.path.join(path + '.tmp', 'manifest.json'), 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(path + '.tmp', path)
+
+    with open(LATEST_FILE + '.tmp', 'w') as latest_file:
+        latest_file.write(version)
+    os.replace(LATEST_FILE + '.tmp', LATEST_FILE)
+    _prune_snapshots()
+    return version
+
+def load_snapshot():
+    # Returns (frames, manifest) of the newest snapshot, or None when there is no usable one
+    if not os.path.exists(LATEST_FILE):
+        return None
+    try:
+        with open(LATEST_FILE, 'r') as latest_file:
+            path = os.path.join(SNAPSHOT_DIR, latest_file.read().strip())
+        with open(os.path.join(path, 'manifest.json'), 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest.get('format') != SNAPSHOT_FORMAT:
+            return None
+        frames = {name: pd.read_parquet(os.path.join(path, f'{name}.parquet'), memory_map=True) for name in manifest['rows']}
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable snapshot: %s", e)
+        return None
+    return frames, manifest
+
+def _prune_snapshots():
+    versions = sorted(
+        (entry for entry in os.listdir(SNAPSHOT_DIR) if entry.startswith('v') and not entry.endswith('.tmp')),
+        key=lambda entry: os.path.getmtime(os.path.join(SNAPSHOT_DIR, entry)),
+    )
+    for entry in versions[:-SNAPSHOTS_KEPT]:
+        shutil.rmtree(os.path.join(SNAPSHOT_DIR, entry), ignore_errors=True)
@@ -0,0 +1,134 @@
+import threading
+import numpy as np
+import pandas as pd
+import streamlit as st
+from distinct_cube import distinct_counts, get_distinct_cube
+from filter_index import DATE_COLUMNS
+
+GRANULARITIES = ('day', 'week', 'month')
+
+# Longest date range (in days) still charted per day, and per week; longer ranges are charted per month
+DAILY_MAX_DAYS = 92
+WEEKLY_MAX_DAYS = 731
+
+# x-axis label format of the time series charts per granularity
+AXIS_FORMATS = {'day': '%Y-%m-%d', 'week': '%Y-%m-%d', 'month': '%Y-%m'}
+
+# Periods without a date
+NO_PERIOD = np.iinfo(np.int64).min
+
+# A (period, customer code) pair is stored as period * PAIR_WIDTH + customer code
+PAIR_WIDTH = 2 ** 32
+
+
+def pick_granularity(start, end):
+    # Coarsest granularity that still shows the selected range in detail
+    days = (pd.Timestamp(end) - pd.Timestamp(start)).days
+    if days <= DAILY_MAX_DAYS:
+        return 'day'
+    if days <= WEEKLY_MAX_DAYS:
+        return 'week'
+    return 'month'
+
+def _periods(dates, granularity):
+    # First day of the period of every date as days since epoch, NO_PERIOD for missing dates
+    days = dates.to_numpy(dtype='datetime64[D]')
+    missing = np.isnat(days)
+    if granularity == 'month':
+        days = days.astype('datetime64[M]').astype('datetime64[D]')
+    periods = days.astype(np.int64)
+    if granularity == 'week':
+        # Weeks start on Monday, day 0 (1970-01-01) is a Thursday
+        periods = periods - (periods + 3) % 7
+    periods[missing] = NO_PERIOD
+    return periods
+
+def _pairs(periods, customers):
+    # Sorted distinct (period, customer) pairs of the cells with a customer
+    present = customers >= 0
+    return np.unique(periods[present] * PAIR_WIDTH + customers[present])
+
+# Registered and active users per day, week and month, counted exactly from the cells of the
+# distinct-count cube. Every cell knows its period at every granularity, so a filtered series is
+# one grouped count over the selected cells. The series of the unfiltered data are kept ready,
+# together with the distinct (period, customer) pairs behind them. When the cube was extended
+# with new results, the period codes of the old cells are carried over and only the pairs of the
+# new cells are looked up: every pair not held yet adds one user to its period.
+class TimeRollups:
+    def __init__(self, cube, previous=None):
+        self.cube = cube
+        incremental = previous is not None and cube.extends is not None and cube.extends() is previous.cube
+        start = len(previous.cube.cells) if incremental else 0
+        # Cells with every date, the ones the date filters of the pages can select
+        self._dated = np.ones(len(cube.cells), dtype=bool)
+        for column in DATE_COLUMNS:
+            self._dated &= cube.cells[column].notna().to_numpy()
+        self._bounds = {column: (cube.cells[column].min(), cube.cells[column].max()) for column in DATE_COLUMNS}
+        self._periods = {}
+        self._series = {}
+        self._pairs = {}
+        cells = start + np.flatnonzero(self._dated[start:])
+        customers = cube.customers[cells]
+        for column in DATE_COLUMNS:
+            for granularity in GRANULARITIES:
+                key = (column, granularity)
+                periods = _periods(cube.cells[column].iloc[start:], granularity)
+                if incremental:
+                    periods = np.concatenate([previous._periods[key], periods])
+                pairs = _pairs(periods[cells], customers)
+                if incremental:
+                    held = previous._pairs[key]
+                    positions = np.searchsorted(held, pairs)
+                    new_pairs = pairs[(positions == len(held)) | (held[np.minimum(positions, len(held) - 1)] != pairs)] if len(held) else pairs
+                    groups, added = np.unique(new_pairs // PAIR_WIDTH, return_counts=True)
+                    # Periods only new cells with a missing customer fall in are listed with no users
+                    series = previous._series[key].reindex(np.union1d(previous._series[key].index, periods[cells]), fill_value=0)
+                    series.loc[groups] += added
+                    pairs = np.insert(held, np.searchsorted(held, new_pairs), new_pairs)
+                else:
+                    # Users per period are the pairs per period
+                    groups = np.unique(periods[cells])
+                    series = pd.Series(np.bincount(np.searchsorted(groups, pairs // PAIR_WIDTH), minlength=len(groups)), index=groups)
+                self._periods[key] = periods
+                self._series[key] = series
+                self._pairs[key] = pairs
+
+    def _unfiltered(self, filters, dates, name):
+        # Whether filters select every dated cell, date ranges covering all the data included
+        if name or any(len(values) for values in (filters or {}).values()):
+            return False
+        for column, (start, end) in (dates or {}).items():
+            low, high = self._bounds[column]
+            if pd.Timestamp(start) > low or pd.Timestamp(end) < high:
+                return False
+        return set(dates or {}) == set(DATE_COLUMNS)
+
+    def series(self, column, granularity, filters=None, dates=None, name=None, count_name='users'):
+        # Distinct users per period of column among the rows passing filters, dates and name,
+        # like df.groupby(column)['Customer ID'].nunique() with column rounded down to the period
+        key = (column, granularity)
+        if self._unfiltered(filters, dates, name):
+            series = self._series[key]
+        else:
+            cells = self.cube.select(filters, dates, name)
+            periods = self._periods[key][cells]
+            present = periods != NO_PERIOD
+            groups, counts = distinct_counts(periods[present], self.cube.customers[cells][present])
+            series = pd.Series(counts, index=groups)
+        return pd.DataFrame({column: series.index.to_numpy(dtype=np.int64).astype('datetime64[D]').astype('datetime64[ns]'),
+                             count_name: series.to_numpy(dtype=np.int64)})
+
+# The last rollups built, so the next data version only recounts the periods that changed
+@st.cache_resource
+def _rollup_state():
+    return {'rollups': None, 'lock': threading.Lock()}
+
+def _build_rollups(dataset):
+    cube = get_distinct_cube(dataset)
+    state = _rollup_state()
+    with state['lock']:
+        state['rollups'] = TimeRollups(cube, state['rollups'])
+        return state['rollups']
+
+def get_time_rollups(dataset):
+    return dataset.derived('time_rollups', _build_rollups)
@@ -0,0 +1,127 @@
+import threading
+from collections import OrderedDict
+import pandas as pd
+from attempts import get_latest_attempts
+from filter_index import get_filter_index
+
+# Layer group of every SAP layer
+LAYER_GROUPS = {
+    'Group 5 Str Layer 1': 'Layer 1',
+    'Group 4 Str Layer 2': 'Layer 2',
+    'Group 3 Str Layer 3B': 'Layer 3',
+    'Group 3 Str Layer 3A': 'Layer 3',
+    'Group 2 Str Layer 4': 'Layer 4',
+    'Group 1 Str Layer 5': 'Layer 5',
+    'Group 1': 'Non Struktural',
+    'Group 2': 'Non Struktural',
+    'Group 3': 'Non Struktural',
+    'Group 4': 'Non Struktural',
+    'Group 5': 'Non Struktural'
+}
+
+LAYER_GROUP_NAMES = ['Layer 1', 'Layer 2', 'Layer 3', 'Layer 4', 'Layer 5', 'Non Struktural']
+
+# Bundles summarised, in display order, and the row of final results added for some of them
+SUMMARY_BUNDLES = ['GI', 'ELITE', 'LEAN']
+OVERALL_TESTS = {'ELITE': 'Overall ELITE', 'LEAN': 'Overall LEAN'}
+
+# Tests listed first within their bundle
+FIRST_TESTS = ["Mindset", "Overall ELITE", "Overall LEAN"]
+
+# Summaries kept per data version, the least recently used ones are dropped first
+SUMMARY_CACHE_SIZE = 32
+
+
+def layers_of(layer_groups):
+    # SAP layers that belong to any of layer_groups
+    return [layer for layer, group in LAYER_GROUPS.items() if group in layer_groups]
+
+def _overall_rows(latest, participant_counts, bundle):
+    # Final results of the latest attempts at bundle, one row per final result
+    counts = latest[latest['bundle_name'] == bundle].groupby('final_result', observed=True)['email'].nunique()
+    participants = participant_counts.set_index('bundle_name')['jumlah_partisipan'].get(bundle, 0)
+    return pd.DataFrame({
+        'bundle_name': bundle,
+        'jumlah_partisipan': participants,
+        'Test Name': OVERALL_TESTS[bundle],
+        'typology': counts.index.astype(object),
+        'jumlah': counts.to_numpy(),
+        'persentase': (counts.to_numpy() / participants * 100).round(2),
+    })
+
+# Traits summary of internal users for any choice of layer groups and units, from the distinct
+# (layer, unit, bundle, test, email) participations materialised once per data version and the
+# latest attempt of every email and test among the chosen rows, picked from the latest-attempt
+# selection of the data version. Distinct emails don't add up over layers and units, so a choice
+# dedupes the participations of the chosen combinations instead of summing precomputed counts;
+# every summary is kept for reuse.
+class TraitsSummary:
+    def __init__(self, dataset):
+        self._merged = dataset.merged
+        self._index = get_filter_index(dataset)
+        self._latest = get_latest_attempts(dataset)
+        internal = dataset.merged.take(self._index.select({'status': ['Internal']}))
+        self._participations = internal[['layer', 'unit', 'bundle_name', 'Test Name', 'email']].drop_duplicates().reset_index(drop=True)
+        self._summaries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _select(self, df, layer_groups, units):
+        if layer_groups:
+            df = df[df['layer'].isin(layers_of(layer_groups))]
+        if units:
+            df = df[df['unit'].isin(units)]
+        return df
+
+    def units(self, layer_groups):
+        # Units of the internal users in layer_groups (all when empty), in order of first appearance
+        return self._select(self._participations, layer_groups, None)['unit'].unique()
+
+    def _build(self, layer_groups, units):
+        participations = self._select(self._participations, layer_groups, units)
+        # Latest attempt of every email and test among the chosen layers and units
+        rows = self._index.select({'status': ['Internal'], 'layer': layers_of(layer_groups), 'unit': units})
+        latest = self._merged.loc[self._latest.select(rows), ['bundle_name', 'Test Name', 'email', 'typology', 'final_result']]
+
+        participant_counts = participations.groupby('bundle_name', observed=True)['email'].nunique().reset_index()
+        participant_counts.columns = ['bundle_name', 'jumlah_partisipan']
+        typology_user_counts = latest.groupby('typology', observed=True)['email'].nunique().reset_index()
+        typology_user_counts.columns = ['typology', 'jumlah']
+        test_names = participations[['bundle_name', 'Test Name']].drop_duplicates()
+
+        # Share of every typology among the users of a test
+        typology_results = latest.groupby(['Test Name', 'typology'], observed=True)['email'].nunique().reset_index()
+        typology_results.columns = ['Test Name', 'typology', 'jumlah']
+        total_users_per_test = typology_results.groupby('Test Name', observed=True)['jumlah'].transform('sum')
+        typology_results['persentase'] = (typology_results['jumlah'] / total_users_per_test * 100).round(2)
+
+        result_df = pd.merge(participant_counts, test_names, on='bundle_name', how='left')
+        result_df = pd.merge(result_df, typology_results, on='Test Name', how='left')
+        overall = [_overall_rows(latest, participant_counts, bundle) for bundle in OVERALL_TESTS]
+        result_df = pd.concat([result_df] + [rows for rows in overall if len(rows)], ignore_index=True)
+
+        result_df = result_df[result_df['bundle_name'].isin(SUMMARY_BUNDLES)]
+        result_df['bundle_name'] = pd.Categorical(result_df['bundle_name'], categories=SUMMARY_BUNDLES, ordered=True)
+        result_df = result_df.sort_values(['bundle_name', 'Test Name']).reset_index(drop=True)
+        result_df = pd.merge(result_df, typology_user_counts[['typology']], on='typology', how='left')
+
+        result_df['sort_order'] = (~result_df['Test Name'].isin(FIRST_TESTS)).astype(int)
+        return result_df.sort_values(['bundle_name', 'sort_order', 'Test Name']).reset_index(drop=True)
+
+    def summary(self, layer_groups=(), units=()):
+        # Summary rows of every bundle in SUMMARY_BUNDLES for the chosen layer groups and units,
+        # empty choices meaning all, sorted by bundle with FIRST_TESTS first. Pages pick the
+        # rows of one bundle; the frame is shared and must not be modified.
+        key = (tuple(layer_groups), tuple(units))
+        with self._lock:
+            if key in self._summaries:
+                self._summaries.move_to_end(key)
+                return self._summaries[key]
+        summary = self._build(list(layer_groups), list(units))
+        with self._lock:
+            self._summaries[key] = summary
+            while len(self._summaries) > SUMMARY_CACHE_SIZE:
+                self._summaries.popitem(last=False)
+        return summary
+
+def get_traits_summary(dataset):
+    return dataset.derived('traits_summary', TraitsSummary)